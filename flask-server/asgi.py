@@ -0,0 +1,239 @@
+import io
+import os
+import json
+import math
+import time
+import asyncio
+from urllib.parse import parse_qs
+from concurrent.futures import ThreadPoolExecutor
+from image_io import cached_result, filter_and_encode, open_image, parse_filter_request, store_result
+from engine import make_filter_engine
+from result_cache import make_result_cache
+
+############################
+# ASGI Front End
+############################
+# An async alternative to server.py for bursty traffic. Uploads are read
+# without blocking the event loop and the filter work runs in a bounded
+# executor. At most ASGI_WORKERS jobs run and at most ASGI_QUEUE wait; any
+# request beyond that gets 503 with Retry-After straight away instead of
+# piling up in memory. Every request has ASGI_DEADLINE seconds from arrival
+# to response, or it gets 504.
+#
+# The body is the raw image, like the binary form of the Lambda handler:
+#   POST /apply-filter?filter=digicam&max_dimension=1280&seed=7
+# ('filter', 'pipeline', 'max_dimension' and 'seed' may also be sent as
+# X-Filter, X-Pipeline, X-Max-Dimension and X-Seed headers; a pipeline is a
+# URL-encoded JSON spec used in place of the filter). GET /healthz reports the admission
+# counters. Run with any ASGI server, e.g.
+#   uvicorn asgi:app
+# or drive it in-process with load_asgi.py.
+
+filter_engine = make_filter_engine()
+ASGI_WORKERS = int(os.environ.get("ASGI_WORKERS", filter_engine.workers if filter_engine else os.cpu_count() or 1))
+ASGI_QUEUE = int(os.environ.get("ASGI_QUEUE", 2 * ASGI_WORKERS))
+ASGI_DEADLINE = float(os.environ.get("ASGI_DEADLINE", 30))
+ASGI_MAX_BODY = int(os.environ.get("ASGI_MAX_BODY", 32 * 1024 * 1024))
+
+result_cache = make_result_cache()
+
+class AdmissionControl:
+    """
+    Counts the requests that hold a job slot (running or queued) and refuses
+    new ones once workers + queue_size are taken. Only touched from the event
+    loop thread, so it needs no lock.
+    """
+
+    def __init__(self, workers, queue_size):
+        """
+        :param workers: Jobs that run at the same time
+        :param queue_size: Jobs allowed to wait for a worker
+        """
+        self.workers = workers
+        self.queue_size = queue_size
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        # Moving average of job run time, for Retry-After
+        self.service_time = 1.0
+
+    def try_admit(self):
+        if self.admitted >= self.workers + self.queue_size:
+            self.rejected += 1
+            return False
+        self.admitted += 1
+        return True
+
+    def release(self, seconds=None):
+        self.admitted -= 1
+        if seconds is not None:
+            self.service_time += 0.2 * (seconds - self.service_time)
+
+    def retry_after(self):
+        """
+        :return: Whole seconds until the current backlog should have drained
+        """
+        return max(1, math.ceil(self.admitted * self.service_time / self.workers))
+
+    def stats(self):
+        return {'workers': self.workers, 'queue_size': self.queue_size, 'admitted': self.admitted,
+                'rejected': self.rejected, 'timed_out': self.timed_out,
+                'service_time': round(self.service_time, 3)}
+
+admission = AdmissionControl(ASGI_WORKERS, ASGI_QUEUE)
+executor = ThreadPoolExecutor(max_workers=ASGI_WORKERS)
+
+def _filter_job(image_data, filter_type, max_dimension, seed, stamp_text, deadline):
+    """
+    Decodes, filters and encodes one upload. Runs in the executor.
+    :return: (encoded image bytes, image format name, seconds spent)
+    """
+    start = time.monotonic()
+    if start > deadline:
+        # Waited out its deadline in the queue; nobody is listening any more
+        raise TimeoutError('Deadline passed before the job started')
+    img = open_image(io.BytesIO(image_data), max_dimension)
+    if filter_engine is not None:
+        data, original_format = filter_engine.run(img, filter_type, seed, stamp_text)
+    else:
+        data, original_format = filter_and_encode(img, filter_type, seed, stamp_text)
+    return data, original_format, time.monotonic() - start
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+    if scope['path'] == '/healthz' and scope['method'] == 'GET':
+        await _send_json(send, 200, admission.stats())
+    elif scope['path'] == '/apply-filter' and scope['method'] == 'POST':
+        await _apply_filter(scope, receive, send)
+    else:
+        await _send_json(send, 404, {'error': 'Not found'})
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            executor.shutdown(wait=False, cancel_futures=True)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def _apply_filter(scope, receive, send):
+    deadline = time.monotonic() + ASGI_DEADLINE
+    headers = {key.decode('latin-1').lower(): value.decode('latin-1') for key, value in scope['headers']}
+    params = {key: values[0] for key, values in parse_qs(scope['query_string'].decode('latin-1')).items()}
+    try:
+        filter_request = parse_filter_request(params.get('filter') or headers.get('x-filter'),
+                                              params.get('pipeline') or headers.get('x-pipeline'),
+                                              params.get('max_dimension') or headers.get('x-max-dimension'),
+                                              params.get('seed') or headers.get('x-seed'))
+        try:
+            content_length = int(headers.get('content-length') or 0)
+        except ValueError:
+            raise ValueError('Content-Length must be an integer')
+    except ValueError as e:
+        await _send_json(send, 400, {'error': str(e)})
+        return
+    if content_length > ASGI_MAX_BODY:
+        await _send_json(send, 413, {'error': f'Image is larger than {ASGI_MAX_BODY} bytes'})
+        return
+
+    # Admit before reading the body, so a burst is refused without buffering it
+    if not admission.try_admit():
+        await _send_json(send, 503, {'error': 'Server busy, retry later'},
+                         [(b'retry-after', str(admission.retry_after()).encode('ascii'))])
+        return
+    released = False
+    try:
+        try:
+            image_data = await asyncio.wait_for(_read_body(receive), deadline - time.monotonic())
+        except ValueError as e:
+            await _send_json(send, 413, {'error': str(e)})
+            return
+        if not image_data:
+            await _send_json(send, 400, {'error': 'No image found in the request body'})
+            return
+
+        cache_key, cached = cached_result(result_cache, image_data, filter_request)
+        if cached is not None:
+            await _send_image(send, cached[0], cached[1], 'HIT')
+            return
+
+        job = executor.submit(_filter_job, image_data, *filter_request, deadline)
+        # The slot is held until the job really finishes: a timed-out job
+        # that already started keeps its worker busy
+        job.add_done_callback(_release_from_worker(asyncio.get_running_loop()))
+        released = True
+        try:
+            data, original_format, _ = await asyncio.wait_for(asyncio.wrap_future(job),
+                                                              deadline - time.monotonic())
+        except (asyncio.TimeoutError, TimeoutError):
+            job.cancel()
+            admission.timed_out += 1
+            await _send_json(send, 504, {'error': f'Not finished within {ASGI_DEADLINE:g} seconds'})
+            return
+        store_result(result_cache, cache_key, data, original_format)
+        await _send_image(send, data, original_format, 'MISS' if cache_key is not None else 'BYPASS')
+    except ConnectionError:
+        return
+    except asyncio.TimeoutError:
+        admission.timed_out += 1
+        await _send_json(send, 504, {'error': f'Upload not received within {ASGI_DEADLINE:g} seconds'})
+    except Exception as e:
+        await _send_json(send, 500, {'error': str(e)})
+    finally:
+        if not released:
+            admission.release()
+
+def _release_from_worker(loop):
+    """
+    :return: Done callback that hands the finished job back to the loop
+    """
+    def callback(job):
+        try:
+            loop.call_soon_threadsafe(_release_job, job)
+        except RuntimeError:
+            pass  # the loop has shut down; there is nothing left to admit
+    return callback
+
+def _release_job(job):
+    seconds = None
+    if not job.cancelled() and job.exception() is None:
+        seconds = job.result()[2]
+    admission.release(seconds)
+
+async def _read_body(receive):
+    """
+    :return: Request body bytes
+    :raises ValueError: if the body is larger than ASGI_MAX_BODY
+    """
+    chunks = []
+    size = 0
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            raise ConnectionError('Client disconnected')
+        chunk = message.get('body', b'')
+        size += len(chunk)
+        if size > ASGI_MAX_BODY:
+            raise ValueError(f'Image is larger than {ASGI_MAX_BODY} bytes')
+        chunks.append(chunk)
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+async def _send_image(send, data, original_format, cache_status):
+    await _send(send, 200, data, [(b'content-type', f'image/{original_format.lower()}'.encode('ascii')),
+                                  (b'x-cache', cache_status.encode('ascii'))])
+
+async def _send_json(send, status, body, extra_headers=()):
+    await _send(send, status, json.dumps(body).encode('utf-8'),
+                [(b'content-type', b'application/json'), *extra_headers])
+
+async def _send(send, status, body, headers):
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-length', str(len(body)).encode('ascii')), *headers]})
+    await send({'type': 'http.response.body', 'body': body})
@@ -0,0 +1,77 @@
+"""
+Measures filter throughput of the process-pool engine against pool size.
+
+For every pool size the same set of jobs is pushed through
+engine.FilterEngine from as many client threads as there are workers (so
+the pool is kept busy) and the report gives images/s, megapixels/s and the
+speed-up over one worker. Size 0 is the in-thread path the server uses when
+FILTER_WORKERS is 0, run from one thread.
+
+    python bench_engine.py [--filter digicam] [--size 1280x960] [--jobs 32]
+                           [--workers 0,1,2,4]
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from bench_lambda import synthetic_jpeg
+
+def run_jobs(engine, img, filter_type, jobs, threads):
+    from image_io import filter_and_encode
+
+    def one_job(_):
+        if engine is not None:
+            return engine.run(img, filter_type)
+        return filter_and_encode(img.copy(), filter_type)
+
+    one_job(None)  # not timed: first call pays for lazy imports and caches
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(one_job, range(jobs)))
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--filter", default="digicam")
+    parser.add_argument("--size", default="1280x960")
+    parser.add_argument("--jobs", type=int, default=32)
+    cores = os.cpu_count() or 1
+    default_workers = [0] + [n for n in (1, 2, 4, 8, 16, 32) if n <= cores]
+    parser.add_argument("--workers", default=",".join(str(n) for n in default_workers))
+    args = parser.parse_args()
+
+    from engine import FilterEngine
+    from image_io import open_image
+
+    width, height = (int(n) for n in args.size.lower().split("x"))
+    with tempfile.TemporaryDirectory() as tmp:
+        image_path = os.path.join(tmp, "input.jpg")
+        synthetic_jpeg(image_path, width, height)
+        with open(image_path, "rb") as f:
+            img = open_image(f)
+
+    megapixels = width * height / 1e6
+    report = {"filter": args.filter, "size": args.size, "jobs": args.jobs, "cores": cores, "workers": {}}
+    single = None
+    for workers in (int(n) for n in args.workers.split(",")):
+        engine = FilterEngine(workers) if workers > 0 else None
+        try:
+            seconds = run_jobs(engine, img, args.filter, args.jobs, max(workers, 1))
+        finally:
+            if engine is not None:
+                engine.close()
+        result = {"seconds": round(seconds, 3),
+                  "images_per_s": round(args.jobs / seconds, 2),
+                  "mp_per_s": round(args.jobs * megapixels / seconds, 2)}
+        if workers == 1:
+            single = seconds
+        if single is not None and workers > 0:
+            result["speedup"] = round(single / seconds, 2)
+        report["workers"][str(workers)] = result
+    print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
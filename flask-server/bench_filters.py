@@ -0,0 +1,143 @@
+"""
+Benchmarks every effect function, every apply_filter preset, and JPEG decode
+and encode on synthetic photos at several resolutions. Runs offline.
+
+For each case the report gives the median and p95 latency in milliseconds
+and the median throughput in megapixels per second. Save a report as a
+baseline and compare later runs against it. Cases whose median is slower
+than the baseline by more than --threshold (a fraction) are listed, and the
+run exits with status 1.
+
+    python bench_filters.py [--sizes 640,1280,12mp,24mp] [--repeat 5]
+                            [--cases digicam,vignette] [--output report.json]
+                            [--save-baseline baseline.json]
+                            [--baseline baseline.json --threshold 0.25]
+"""
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+
+from bench_lambda import synthetic_jpeg
+from profiling import effect_stages, encode_jpeg, preset_stages
+
+SIZES = {
+    "640": (640, 480),
+    "1280": (1280, 960),
+    "12mp": (4000, 3000),
+    "24mp": (6000, 4000),
+}
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+def time_case(func, make_input, repeat):
+    """
+    :param func: func(input), the code being timed
+    :param make_input: Builds a fresh input for each run, outside the timing
+    :param repeat: Timed runs, after one untimed warm-up run
+    :return: List of seconds
+    """
+    func(make_input())
+    samples = []
+    for _ in range(repeat):
+        case_input = make_input()
+        start = time.perf_counter()
+        func(case_input)
+        samples.append(time.perf_counter() - start)
+    return samples
+
+def run_size(name, repeat, selected):
+    from image_io import open_image
+
+    width, height = SIZES[name]
+    megapixels = width * height / 1e6
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "input.jpg")
+        synthetic_jpeg(path, width, height)
+        with open(path, "rb") as f:
+            data = f.read()
+    img = open_image(io.BytesIO(data))
+    rgb = img.convert("RGB")
+
+    cases = {"decode": (open_image, lambda: io.BytesIO(data))}
+    for case, func in {**preset_stages(), **effect_stages()}.items():
+        cases[case] = (func, img.copy)
+    cases["encode"] = (encode_jpeg, lambda: rgb)
+
+    results = {}
+    for case, (func, make_input) in cases.items():
+        if selected and not any(word in case for word in selected):
+            continue
+        try:
+            samples = time_case(func, make_input, repeat)
+        except Exception as e:
+            results[case] = {"error": str(e)}
+            continue
+        median = percentile(samples, 0.5)
+        results[case] = {"median_ms": round(median * 1000, 3),
+                         "p95_ms": round(percentile(samples, 0.95) * 1000, 3),
+                         "mp_per_s": round(megapixels / median, 2)}
+        print(f"{name:>5} {case:<30} {results[case]['median_ms']:>10.1f} ms", file=sys.stderr)
+    return results
+
+def compare(report, baseline, threshold):
+    """
+    :return: List of (size, case, baseline ms, current ms) for every case
+             slower than baseline * (1 + threshold)
+    """
+    regressions = []
+    for size, cases in report["results"].items():
+        for case, result in cases.items():
+            before = baseline.get("results", {}).get(size, {}).get(case, {})
+            if "median_ms" in result and "median_ms" in before:
+                if result["median_ms"] > before["median_ms"] * (1 + threshold):
+                    regressions.append((size, case, before["median_ms"], result["median_ms"]))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default=",".join(SIZES))
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--cases", help="Comma separated substrings of the case names to run")
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    parser.add_argument("--save-baseline", help="Also write the report to this baseline file")
+    parser.add_argument("--baseline", help="Compare against this baseline file")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="Allowed slowdown over the baseline median, as a fraction")
+    args = parser.parse_args()
+
+    sizes = args.sizes.split(",")
+    unknown = [size for size in sizes if size not in SIZES]
+    if unknown:
+        parser.error(f"unknown sizes: {', '.join(unknown)} (choose from {', '.join(SIZES)})")
+    selected = args.cases.split(",") if args.cases else None
+
+    report = {"python": platform.python_version(), "platform": platform.platform(),
+              "cpus": os.cpu_count(), "repeat": args.repeat,
+              "sizes": {size: list(SIZES[size]) for size in sizes},
+              "results": {size: run_size(size, args.repeat, selected) for size in sizes}}
+
+    output = json.dumps(report, indent=2)
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, "w") as f:
+                f.write(output + "\n")
+    if not args.output:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.threshold)
+        for size, case, before, after in regressions:
+            print(f"REGRESSION {size} {case}: {before:.1f} ms -> {after:.1f} ms", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
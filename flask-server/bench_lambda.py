@@ -0,0 +1,101 @@
+"""
+Measures Lambda cold start and warm latency locally.
+
+Each trial runs lambda_handler in a fresh Python process and reports:
+  import_ms       importing the handler module (the Lambda init phase)
+  first_ms        the first invocation in that process
+  warm_ms         median of the following invocations
+Modes: "lazy" (default handler), "preload" (PRELOAD_FILTERS=1) and "warmup"
+(a warm-up event is sent before the first invocation; its time is reported
+as warmup_ms).
+
+    python bench_lambda.py [--filter digicam] [--size 1280x960] [--trials 5]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def child(image_path, filter_type, warm_runs, warmup_size):
+    start = time.perf_counter()
+    import test
+    result = {"import_ms": (time.perf_counter() - start) * 1000}
+
+    with open(image_path, "rb") as f:
+        event = test.make_binary_event(f.read(), filter_type)
+    if warmup_size:
+        start = time.perf_counter()
+        test.lambda_handler({"warmup": True, "sizes": [warmup_size]}, None)
+        result["warmup_ms"] = (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    response = test.lambda_handler(event, None)
+    result["first_ms"] = (time.perf_counter() - start) * 1000
+    if response["statusCode"] != 200:
+        sys.exit(response["body"])
+
+    warm = []
+    for _ in range(warm_runs):
+        start = time.perf_counter()
+        test.lambda_handler(event, None)
+        warm.append((time.perf_counter() - start) * 1000)
+    result["warm_ms"] = statistics.median(warm)
+    print(json.dumps(result))
+
+def synthetic_jpeg(path, width, height):
+    import numpy as np
+    from PIL import Image
+    y, x = np.mgrid[0:height, 0:width]
+    pixels = np.stack([127 + 120 * np.sin(x / 97.0),
+                       127 + 120 * np.cos(y / 53.0),
+                       255.0 * (x + y) / (width + height)], axis=-1)
+    pixels += np.random.default_rng(0).normal(0, 12, pixels.shape)
+    Image.fromarray(np.clip(pixels, 0, 255).astype("uint8")).save(path, "JPEG", quality=85)
+
+def run_trial(image_path, args, mode):
+    env = dict(os.environ)
+    env.pop("PRELOAD_FILTERS", None)
+    if mode == "preload":
+        env["PRELOAD_FILTERS"] = "1"
+    command = [sys.executable, __file__, "--child", image_path,
+               "--filter", args.filter, "--warm-runs", str(args.warm_runs)]
+    if mode == "warmup":
+        command += ["--warmup-size", args.size]
+    output = subprocess.run(command, cwd=HERE, env=env, check=True,
+                            capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--filter", default="digicam")
+    parser.add_argument("--size", default="1280x960")
+    parser.add_argument("--trials", type=int, default=5)
+    parser.add_argument("--warm-runs", type=int, default=5)
+    parser.add_argument("--modes", default="lazy,preload,warmup")
+    parser.add_argument("--child")
+    parser.add_argument("--warmup-size")
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child, args.filter, args.warm_runs, args.warmup_size)
+        return
+
+    width, height = (int(n) for n in args.size.lower().split("x"))
+    with tempfile.TemporaryDirectory() as tmp:
+        image_path = os.path.join(tmp, "input.jpg")
+        synthetic_jpeg(image_path, width, height)
+        report = {"filter": args.filter, "size": args.size, "trials": args.trials, "modes": {}}
+        for mode in args.modes.split(","):
+            trials = [run_trial(image_path, args, mode) for _ in range(args.trials)]
+            report["modes"][mode] = {key: round(statistics.median(t[key] for t in trials), 1)
+                                     for key in trials[0]}
+    print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+import os
+import atexit
+import multiprocessing
+from multiprocessing import resource_tracker, shared_memory
+from PIL import Image
+
+############################
+# Filter Engine
+############################
+# Runs apply_filter in a pool of worker processes, so filters that hold the
+# GIL (PIL drawing, Python loops) use more than one core. The pool is forked
+# up front and every worker warms the filter caches once. Decoded pixels go
+# to the worker through a shared memory segment instead of being pickled;
+# only the small encoded result comes back through the pool's pipe.
+
+def _init_worker():
+    import filters
+    filters.warm_caches()
+
+def _run_job(segment_name, mode, size, image_format, filter_type, seed, stamp_text):
+    """
+    Worker side of FilterEngine.run.
+    :return: (encoded image bytes, image format name)
+    """
+    from image_io import filter_and_encode
+
+    # The parent owns the segment and unlinks it once the job is done
+    segment = shared_memory.SharedMemory(name=segment_name)
+    try:
+        img = Image.frombytes(mode, size, segment.buf)
+    finally:
+        segment.close()
+    img.format = image_format
+
+    return filter_and_encode(img, filter_type, seed, stamp_text)
+
+class FilterEngine:
+    """
+    A pre-forked pool of filter workers.
+    """
+
+    def __init__(self, workers, timeout=60):
+        """
+        :param workers: Number of worker processes
+        :param timeout: Seconds to wait for one job before giving up
+        """
+        self.workers = workers
+        self.timeout = timeout
+        # Start the resource tracker before forking so the workers share it;
+        # otherwise each worker starts its own, which reports every segment
+        # it attached to as leaked
+        resource_tracker.ensure_running()
+        self._pool = multiprocessing.Pool(workers, initializer=_init_worker)
+
+    def run(self, img, filter_type, seed=None, stamp_text=None):
+        """
+        Applies a filter in a worker and returns the encoded result, like
+        server.filter_image.
+        :param img: PIL Image
+        :param filter_type: Name of the filter
+        :param seed: Optional seed for the random parts of the filter
+        :param stamp_text: Optional date stamp text
+        :return: (encoded image bytes, image format name)
+        """
+        image_format = img.format
+        if img.palette is not None:
+            # The palette would not survive the trip; filters want RGB anyway
+            img = img.convert("RGB")
+        data = img.tobytes()
+        segment = shared_memory.SharedMemory(create=True, size=max(len(data), 1))
+        try:
+            segment.buf[:len(data)] = data
+            del data
+            job = self._pool.apply_async(_run_job, (segment.name, img.mode, img.size, image_format,
+                                                    filter_type, seed, stamp_text))
+            return job.get(self.timeout)
+        finally:
+            segment.close()
+            segment.unlink()
+
+    def close(self):
+        self._pool.terminate()
+        self._pool.join()
+
+def make_filter_engine(workers=None):
+    """
+    Builds the engine configured by the argument or, where it is None, the
+    FILTER_WORKERS environment variable ("auto" for one worker per core).
+    FILTER_TIMEOUT sets the per-job timeout in seconds.
+    :return: FilterEngine, or None when workers is 0 (filter in the caller)
+    """
+    if workers is None:
+        workers = os.environ.get("FILTER_WORKERS", "0")
+    if workers == "auto":
+        workers = os.cpu_count() or 1
+    workers = int(workers)
+    if workers <= 0:
+        return None
+    engine = FilterEngine(workers, timeout=float(os.environ.get("FILTER_TIMEOUT", 60)))
+    atexit.register(engine.close)
+    return engine
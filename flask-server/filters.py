@@ -0,0 +1,1699 @@
+from PIL import Image, ImageDraw, ImageFilter, ImageFont
+import os
+import json
+import math
+import hashlib
+import numpy as np
+from datetime import datetime
+from collections import namedtuple
+from functools import lru_cache
+from timing import stage
+
+def make_rng(seed=None):
+    """
+    Random generator for the noisy effects (grain, light leaks, VHS lines,
+    lens flare). The same seed always gives the same output; None draws
+    fresh entropy.
+    :param seed: int or None
+    :return: numpy Generator
+    """
+    return np.random.default_rng(seed)
+
+############################
+# 1. Film Grain
+############################
+GRAIN_TILE = 512
+GRAIN_BANK_SIZE = 4
+GRAIN_BANK_SEED = 0x6772
+
+@lru_cache(maxsize=16)
+def grain_textures(intensity, offset):
+    """
+    Bank of tileable grain textures. Every texel is drawn independently from
+    [-offset, intensity - offset), the same distribution add_film_grain has
+    always used, so the textures tile without seams. The bank is built from a
+    fixed seed so seeded requests render the same in every process.
+    :param intensity: Max noise value, as in add_film_grain
+    :param offset: Offset to shift the noise distribution
+    :return: read-only int8 array (GRAIN_BANK_SIZE, GRAIN_TILE, GRAIN_TILE)
+    """
+    if not (0 <= offset <= 128 and 0 < intensity - offset <= 128):
+        raise ValueError("grain intensity/offset out of int8 range")
+    textures = make_rng(GRAIN_BANK_SEED).integers(
+        -offset, intensity - offset, (GRAIN_BANK_SIZE, GRAIN_TILE, GRAIN_TILE), dtype=np.int8)
+    textures.flags.writeable = False
+    return textures
+
+def grain_tile(intensity, offset, rng):
+    """
+    Picks a random texture from the bank and rolls it by a random offset.
+    :return: int8 array (GRAIN_TILE, GRAIN_TILE)
+    """
+    textures = grain_textures(intensity, offset)
+    dy, dx = rng.integers(0, GRAIN_TILE, 2)
+    return np.roll(textures[rng.integers(len(textures))], (dy, dx), axis=(0, 1))
+
+def grain_blocks(height, width):
+    """
+    Yields (y, x, h, w) blocks covering the frame in GRAIN_TILE steps.
+    """
+    for y in range(0, height, GRAIN_TILE):
+        for x in range(0, width, GRAIN_TILE):
+            yield y, x, min(GRAIN_TILE, height - y), min(GRAIN_TILE, width - x)
+
+def add_film_grain(image, intensity=50, offset=25, rng=None):
+    """
+    Adds film-like grain by injecting random noise. The noise is tiled from
+    grain_textures and added to all three channels with a saturating uint8
+    add, one block at a time.
+    :param image: PIL Image
+    :param intensity: Max noise value (0-255). Higher => more grain
+    :param offset: Offset to shift the noise distribution
+    :param rng: numpy Generator from make_rng, or None for a fresh one
+    :return: PIL Image with film grain
+    """
+    if rng is None:
+        rng = make_rng()
+    np_img = np.array(image.convert('RGB'))
+    # split the tile into its positive and negative parts, spread over R/G/B
+    # once per call (tile-sized, not frame-sized) so the block loop below
+    # runs on contiguous rows
+    tile = grain_tile(intensity, offset, rng).astype(np.int16)[..., None]
+    lift = np.repeat(np.maximum(tile, 0).astype(np.uint8), 3, axis=2)
+    drop = np.repeat(np.maximum(-tile, 0).astype(np.uint8), 3, axis=2)
+    scratch = np.empty((GRAIN_TILE, GRAIN_TILE, 3), dtype=np.uint8)
+    for y, x, h, w in grain_blocks(np_img.shape[0], np_img.shape[1]):
+        block = np_img[y:y + h, x:x + w]
+        tmp = scratch[:h, :w]
+        # saturating add: never lift above 255 or drop below 0
+        np.subtract(255, block, out=tmp)
+        np.minimum(tmp, lift[:h, :w], out=tmp)
+        block += tmp
+        np.minimum(block, drop[:h, :w], out=tmp)
+        block -= tmp
+    return Image.fromarray(np_img)
+
+############################
+# 2. Light Leaks
+############################
+def add_light_leaks(image, leak_count=5, alpha=0.25, feather=1.0, rng=None):
+    """
+    Adds random circular color overlays ("light leaks"), each blended into
+    its own bounding box from a cached disc sprite; the rest of the image is
+    left as it is.
+    :param image: PIL Image
+    :param leak_count: How many leaks
+    :param alpha: Blend factor
+    :param feather: Width in pixels of the soft rim (0 for a hard edge)
+    :param rng: numpy Generator from make_rng, or None for a fresh one
+    :return: PIL Image
+    """
+    image = image.convert('RGB')
+    for x, y, radius, color in random_light_leaks(image.size, leak_count, rng):
+        paste_disc(image, x, y, radius, color, alpha, feather)
+    return image
+
+LIGHT_LEAK_COLORS = [
+    (255, 200, 100),
+    (255, 150, 50),
+    (255, 50, 50),
+    (255, 220, 180),
+    (255, 100, 200),
+]
+
+def random_light_leaks(size, leak_count, rng=None):
+    """
+    Picks random positions, radii and colors for light leaks.
+    :param size: (width, height) of the image
+    :param leak_count: How many leaks
+    :param rng: numpy Generator from make_rng, or None for a fresh one
+    :return: List of (x, y, radius, color) tuples
+    """
+    if rng is None:
+        rng = make_rng()
+    width, height = size
+    leaks = []
+    for _ in range(leak_count):
+        x = int(rng.integers(0, width + 1))
+        y = int(rng.integers(0, height + 1))
+        radius = int(rng.integers(50, 201))
+        color = LIGHT_LEAK_COLORS[rng.integers(len(LIGHT_LEAK_COLORS))]
+        leaks.append((x, y, radius, color))
+    return leaks
+
+############################
+# 3. Vignette
+############################
+def apply_vignette(image, radius_factor=1.6, strength=0.7, budget=None):
+    """
+    Darken edges to create a vignette.
+    :param image: PIL Image
+    :param radius_factor: Determines ellipse size
+    :param strength: How strong (dark) the vignette is
+    :param budget: Working memory limit in bytes, see map_strips
+    :return: PIL Image
+    """
+    width, height = image.size
+
+    def vignette_strip(strip, top):
+        mask = vignette_rows(width, height, radius_factor, strength, top, top + strip.height)
+        black = Image.new('RGB', strip.size, (0, 0, 0))
+        return Image.composite(black, strip.convert('RGB'), mask)
+
+    return map_strips(image, vignette_strip, bytes_per_pixel=12, budget=budget)
+
+def vignette_rows(width, height, radius_factor, strength, top, bottom):
+    """
+    Darkening mask used by apply_vignette for rows top:bottom: a circle of
+    radius min(width, height) // radius_factor, Gaussian blurred with radius
+    width // 4, inverted and scaled by strength. Upsampled from the small
+    cached vignette_circle, so no full-frame plane is built even when the
+    image is processed in strips, and any rows come out as they would for
+    the whole frame.
+    :return: 'L' Image (width, bottom - top), 0 = untouched, 255 = black
+    """
+    circle, factor = vignette_circle(width, height, radius_factor)
+    rows = circle.resize((width, bottom - top), Image.BILINEAR,
+                         box=(0, top / factor, width / factor, bottom / factor))
+    return rows.point(lambda x: (255 - x) * strength)
+
+@lru_cache(maxsize=32)
+def vignette_circle(width, height, radius_factor=1.6):
+    """
+    The blurred circle behind vignette_rows, at the reduced scale of the
+    pyramid blur (see Blurs). The circle is drawn straight at that scale,
+    8x supersampled and box-reduced, instead of being drawn full size and
+    reduced, which leaves the same image without a full-frame temporary.
+
+    Against the mask drawn full size and blurred with PIL's GaussianBlur,
+    from 640 px wide up 99% of the mask is within 10 levels and all of it
+    within 15; on thumbnails, where the blur is as wide as the frame, up to
+    25. A pixel moves by at most that times strength * value / 255.
+    :return: ('L' Image of about width / factor by height / factor, factor)
+    """
+    sigma = max(width // 4, 1)
+    factor = blur_factor(sigma)
+    supersample = 8 if factor > 1 else 1
+    scale = supersample / factor
+    size = (-(-width // factor) * supersample, -(-height // factor) * supersample)
+    radius = int(min(width, height) // radius_factor)
+    circle = Image.new('L', size, 0)
+    # The full-size ellipse covers pixels cx - radius .. cx + radius
+    ImageDraw.Draw(circle).ellipse(
+        [((width // 2 - radius) * scale, (height // 2 - radius) * scale),
+         ((width // 2 + radius + 1) * scale - 1, (height // 2 + radius + 1) * scale - 1)],
+        fill=255
+    )
+    if supersample > 1:
+        circle = circle.reduce(supersample)
+    return circle.filter(ImageFilter.GaussianBlur(_reduced_radius(sigma, factor))), factor
+
+############################
+# 4. Sepia
+############################
+def apply_sepia(img):
+    """
+    Applies a sepia effect.
+    :param img: PIL Image
+    :return: PIL Image
+    """
+    # Lower saturation first, then the sepia matrix, in one pass
+    return apply_color_ops(img, SEPIA_OPS)
+
+############################
+# 5. Cross Processing
+############################
+def apply_cross_processing(img):
+    """
+    Mimic cross-processing effect via color shifts.
+    :param img: PIL Image
+    :return: PIL Image
+    """
+    return apply_lut(img, cross_processing_lut())
+
+############################
+# 6. Lomo Effect
+############################
+def apply_lomo(image):
+    """
+    Lomo-style effect: high contrast, saturated colors, heavy vignette.
+    :param image: PIL Image
+    :return: PIL Image
+    """
+    # Boost saturation, slight contrast bump and a subtle green shift (cheap
+    # lens effect), in one pass
+    lomo_img = apply_color_ops(image, LOMO_OPS)
+
+    # Heavy vignette
+    lomo_img = apply_vignette(lomo_img, radius_factor=1.3, strength=1.0)
+    return lomo_img
+
+############################
+# 7. Chromatic Aberration
+############################
+def add_chromatic_aberration(img, shift=5):
+    """
+    Slightly misalign color channels: red moves right and blue left by shift
+    pixels, and the columns they uncover go black. Whole-pixel shifts are
+    array slices; a fractional shift blends the two nearest ones linearly.
+    :param img: PIL Image
+    :param shift: Pixel shift for R/B, may be fractional or negative
+    :return: PIL Image
+    """
+    r, g, b = img.convert('RGB').split()
+    r = Image.fromarray(shift_columns(np.asarray(r), shift))
+    b = Image.fromarray(shift_columns(np.asarray(b), -shift))
+    return Image.merge("RGB", (r, g, b))
+
+def shift_columns(plane, shift):
+    """
+    :param plane: uint8 array (height, width)
+    :param shift: Pixels to move the plane right (left if negative)
+    :return: uint8 array, zero where nothing was shifted in
+    """
+    whole = math.floor(shift)
+    moved = _shift_columns(plane, whole)
+    fraction = shift - whole
+    if not fraction:
+        return moved
+    blend = moved * np.float32(1 - fraction)
+    blend += _shift_columns(plane, whole + 1) * np.float32(fraction)
+    return np.rint(blend, out=blend).astype(np.uint8)
+
+def _shift_columns(plane, shift):
+    out = np.zeros_like(plane)
+    width = plane.shape[1]
+    if abs(shift) >= width:
+        return out
+    if shift >= 0:
+        out[:, shift:] = plane[:, :width - shift]
+    else:
+        out[:, :shift] = plane[:, -shift:]
+    return out
+
+############################
+# 8. Halation (Bloom / Glow)
+############################
+def add_halation(img, blur_radius=15, intensity=0.4, threshold=180, knee=0,
+                 tint=(255, 255, 255), budget=None):
+    """
+    Adds a soft glow around bright areas.
+    The bright pass and its blur run on one luminance plane, which is only
+    spread over the three channels (and tinted) for the blend.
+    :param img: PIL Image
+    :param blur_radius: How big the glow is
+    :param intensity: Blend strength
+    :param threshold: Luminance above which pixels glow
+    :param knee: Width in levels of a smooth ramp around threshold; 0 for a
+                 hard cut-off
+    :param tint: Glow color; white gives the plain bloom, e.g. (255, 90, 40)
+                 the red fringe of film halation
+    :param budget: Working memory limit in bytes, see map_strips
+    :return: PIL Image
+    """
+    tint = tuple(tint)
+
+    def halation_strip(strip, top):
+        base = strip.convert("RGB")
+        bright = apply_lut(base.convert("L"), bright_pass_lut(threshold, knee))
+        glow = gaussian_blur(bright, blur_radius)
+        if tint == (255, 255, 255):
+            glow = glow.convert("RGB")
+        else:
+            glow = apply_lut(glow, tint_lut(tint))
+        return Image.blend(base, glow, intensity)
+
+    return map_strips(img, halation_strip, halo=blur_halo(blur_radius), bytes_per_pixel=16,
+                      budget=budget, align=blur_factor(blur_radius))
+
+############################
+# 9. Dust & Scratches Overlay
+############################
+def add_dust_and_scratches(img, dust_image_path="dust_texture.png", alpha=0.3):
+    """
+    Overlays a dust/scratches texture.
+    :param img: PIL Image
+    :param dust_image_path: Path to dust texture
+    :param alpha: Blend factor
+    :return: PIL Image
+    """
+    base = img.convert("RGBA")
+    dust = Image.open(dust_image_path).convert("RGBA")
+    dust = dust.resize(img.size)
+    dust.putalpha(int(alpha * 255))
+    return Image.alpha_composite(base, dust).convert("RGB")
+
+############################
+# 10. Date/Time Stamp
+############################
+def add_date_stamp_bottom_right(img, text=None, padding=50, font_size=52, color=(255,222,33),
+                                font_name="default"):
+    """
+    Adds a date/time stamp to the bottom-right corner with a bigger font.
+    The text comes from cached glyph sprites and only the stamp region of the
+    image is touched.
+    :param img: PIL Image, modified in place when it is RGB or RGBA; other
+                modes (palette, grayscale) are converted to RGB first, since a
+                color cannot be blended into them through a mask
+    :param text: Stamp text, defaults to the current date and time
+    :param padding: Distance from the bottom and right edges
+    :param font_size: Font size in pixels
+    :param color: Text color
+    :param font_name: Key into FONTS
+    :return: PIL Image
+    """
+    if text is None:
+        text = current_stamp_text()
+    
+    mask, left, top = text_sprite(font_name, font_size, text)
+    if mask is None:
+        return img
+    if img.mode not in ("RGB", "RGBA"):
+        img = img.convert("RGB")
+    
+    # Same placement as ImageDraw.text at (x, y) with the text box measured from (0, 0)
+    img_width, img_height = img.size
+    x = img_width - mask.width - padding + left
+    y = img_height - mask.height - padding + top
+    paste_sprite(img, mask, color, x, y)
+    return img
+
+FONT_DIR = os.path.dirname(os.path.abspath(__file__))
+FONTS = {
+    "default": "font.ttf",
+    "roboto-black": "Roboto-Black.ttf",
+}
+
+@lru_cache(maxsize=16)
+def load_font(font_name, font_size):
+    """
+    Loads one of the bundled fonts, resolved next to this file.
+    :param font_name: Key into FONTS
+    :param font_size: Font size in pixels
+    :return: PIL FreeTypeFont
+    """
+    if font_name not in FONTS:
+        raise ValueError(f"Unknown font: {font_name}")
+    return ImageFont.truetype(os.path.join(FONT_DIR, FONTS[font_name]), font_size)
+
+@lru_cache(maxsize=512)
+def glyph_sprite(font_name, font_size, char):
+    """
+    Pre-rasterized alpha mask for one character.
+    :param font_name: Key into FONTS
+    :param font_size: Font size in pixels
+    :param char: Single character
+    :return: (mask, left, top, advance); mask is a PIL 'L' Image or None for
+             blank glyphs, (left, top) is its offset from the pen position
+    """
+    font = load_font(font_name, font_size)
+    left, top, right, bottom = font.getbbox(char)
+    advance = font.getlength(char)
+    if right <= left or bottom <= top:
+        return None, left, top, advance
+    mask = Image.new('L', (right - left, bottom - top), 0)
+    ImageDraw.Draw(mask).text((-left, -top), char, font=font, fill=255)
+    return mask, left, top, advance
+
+@lru_cache(maxsize=8)
+def text_sprite(font_name, font_size, text):
+    """
+    Alpha mask for a whole string, assembled from glyph sprites.
+    The date stamp only changes once a minute, so the last few are kept.
+    :param font_name: Key into FONTS
+    :param font_size: Font size in pixels
+    :param text: Text to render
+    :return: (mask, left, top) like glyph_sprite, mask is None for blank text
+    """
+    placed = []
+    pen = 0.0
+    for char in text:
+        mask, left, top, advance = glyph_sprite(font_name, font_size, char)
+        if mask is not None:
+            placed.append((mask, int(round(pen)) + left, top))
+        pen += advance
+    if not placed:
+        return None, 0, 0
+    
+    x0 = min(x for _, x, _ in placed)
+    y0 = min(y for _, _, y in placed)
+    x1 = max(x + mask.width for mask, x, _ in placed)
+    y1 = max(y + mask.height for mask, _, y in placed)
+    sprite = Image.new('L', (x1 - x0, y1 - y0), 0)
+    for mask, x, y in placed:
+        sprite.paste(255, (x - x0, y - y0, x - x0 + mask.width, y - y0 + mask.height), mask)
+    return sprite, x0, y0
+
+############################
+# 11. Polaroid / Instant Camera Frame
+############################
+def add_polaroid_frame(img, frame_width=50, bottom_extra=30, background_color=(255, 255, 255)):
+    """
+    Adds a Polaroid-style frame: thicker at the bottom.
+    :param img: PIL Image
+    :param frame_width: Border thickness for sides/top
+    :param bottom_extra: Extra thickness at bottom
+    :param background_color: Frame color (white)
+    :return: PIL Image
+    """
+    width, height = img.size
+    new_width = width + frame_width * 2
+    new_height = height + frame_width + bottom_extra
+    frame = Image.new('RGB', (new_width, new_height), background_color)
+    frame.paste(img, (frame_width, frame_width))
+    return frame
+
+############################
+# 12. Glitch / VHS Overlay
+############################
+def add_vhs_glitch(img, line_height=2, glitch_strength=10, alpha=0.3, displacement=0, rng=None):
+    """
+    Adds horizontal glitch lines for a VHS look: a translucent red line
+    every other line_height rows, its ends jittered by up to glitch_strength
+    pixels. The lines are a per-row column range built from one vector of
+    random offsets, so no row is drawn from Python.
+    :param img: PIL Image
+    :param line_height: Height of glitch lines
+    :param glitch_strength: Horizontal shift
+    :param alpha: Unused; kept so existing calls still work (the fade it
+                  controlled left every pixel unchanged)
+    :param displacement: Also slide the picture under each line sideways
+                         by up to this many pixels, edges repeated
+    :param rng: numpy Generator from make_rng, or None for a fresh one
+    :return: PIL Image
+    """
+    if rng is None:
+        rng = make_rng()
+    base = img.convert("RGB")
+    width, height = base.size
+    period = line_height * 2
+    shifts = rng.integers(-glitch_strength, glitch_strength + 1, size=-(-height // period))
+
+    # Line n covers rows n * period .. n * period + line_height (inclusive,
+    # like ImageDraw.rectangle) and columns shift .. width + shift
+    rows = np.arange(height)
+    line = rows // period
+    covered = rows % period <= line_height
+    first = np.maximum(shifts, 0)[line]
+    last = np.minimum(width + shifts, width - 1)[line]
+    columns = np.arange(width)
+    mask = (columns >= first[:, None]) & (columns <= last[:, None])
+    mask &= covered[:, None]
+
+    if displacement:
+        offsets = rng.integers(-displacement, displacement + 1, size=len(shifts))
+        # Gathered as one uint32 per RGBA pixel, which numpy moves faster
+        # than three separate bytes
+        pixels = np.array(base.convert("RGBA"))
+        packed = pixels.view(np.uint32)[..., 0]
+        moved = rows[covered]
+        source = np.clip(columns - offsets[line[moved], None], 0, width - 1)
+        packed[moved] = packed.ravel().take(source + (moved * width)[:, None])
+        base = Image.fromarray(pixels).convert("RGB")
+
+    return Image.composite(apply_lut(base, vhs_line_lut()), base, Image.fromarray(mask))
+
+############################
+# 13. Lens Flare
+############################
+def add_lens_flare(img, flare_center=None, radius=80, color=(255, 255, 200), intensity=0.4,
+                   feather=1.0, rng=None):
+    """
+    Adds a lens flare circle, blended only inside its bounding box.
+    :param img: PIL Image
+    :param flare_center: (x, y) if None, random
+    :param radius: Radius of flare
+    :param color: Flare color
+    :param intensity: Blend factor
+    :param feather: Width in pixels of the soft rim (0 for a hard edge)
+    :param rng: numpy Generator from make_rng, or None for a fresh one
+    :return: PIL Image
+    """
+    width, height = img.size
+    if flare_center is None:
+        if rng is None:
+            rng = make_rng()
+        flare_center = (int(rng.integers(0, width + 1)), int(rng.integers(0, height + 1)))
+
+    img = img.convert('RGB')
+    paste_disc(img, flare_center[0], flare_center[1], radius, color, intensity, feather)
+    return img
+
+############################
+# 14. Tilt-Shift / Depth of Field
+############################
+def apply_tilt_shift(image, blur_strength=15, focus_center=None, focus_height=100, budget=None):
+    """
+    Simulates tilt-shift by blurring top/bottom, leaving a central band in focus.
+    :param image: PIL Image
+    :param blur_strength: GaussianBlur radius
+    :param focus_center: Vertical center of focus band
+    :param focus_height: Height of the band in focus
+    :param budget: Working memory limit in bytes, see map_strips
+    :return: PIL Image
+    """
+    width, height = image.size
+    if focus_center is None:
+        focus_center = height // 2
+    top_focus = focus_center - focus_height // 2
+    bottom_focus = focus_center + focus_height // 2
+
+    def tilt_shift_strip(strip, top):
+        strip = strip.convert('RGB')
+        blurred = gaussian_blur(strip, blur_strength)
+
+        # The band spans the full width, so its feathered edges only vary
+        # down the image: blur one column and stretch it across
+        column = Image.new('L', (1, strip.height), 0)
+        ImageDraw.Draw(column).rectangle([(0, top_focus - top), (1, bottom_focus - top)], fill=255)
+        column = gaussian_blur(column, blur_strength // 2)
+        mask = column.resize(strip.size, Image.NEAREST)
+
+        return Image.composite(strip, blurred, mask)
+
+    return map_strips(image, tilt_shift_strip, halo=blur_halo(blur_strength), bytes_per_pixel=16,
+                      budget=budget, align=blur_factor(blur_strength))
+
+def add_green_tint(image, factor=1.05):
+    """
+    Adds a mild green tint by scaling the green channel.
+    
+    :param image: PIL Image
+    :param factor: How much to multiply the green channel (1.0 = no change)
+    :return: PIL Image with a greenish tint
+    """
+    # e.g. factor=1.05 => 5% more green
+    return apply_lut(image, green_tint_lut(factor))
+
+############################
+# 15. Posterize (Example of Cross Hatch / Sketch / Posterize)
+############################
+def apply_posterize(image, bits=3):
+    """
+    Posterize the image to reduce color levels.
+    :param image: PIL Image
+    :param bits: Number of bits (1-8). Lower => fewer colors.
+    :return: PIL Image
+    """
+    return apply_lut(image, posterize_lut(bits))
+
+############################
+# 16. Lookup Tables
+############################
+# Point-wise filters are stored as uint8 tables of shape (3, 256), one row per
+# R/G/B channel. A chain of them composes into a single table, which PIL then
+# applies to the image in one point() pass.
+LUT_INPUT = np.arange(256, dtype=np.float64)
+
+def make_lut(func=None, red=None, green=None, blue=None):
+    """
+    Builds a per-channel lookup table.
+    :param func: Applied to every channel not given its own function
+    :param red: Function for the red channel
+    :param green: Function for the green channel
+    :param blue: Function for the blue channel
+    Each function takes a float64 array of 0-255 and returns new values,
+    which are clipped and truncated to uint8 like the array code they replace.
+    Channels without a function are left unchanged.
+    :return: Read-only uint8 array (3, 256)
+    """
+    rows = []
+    for channel_func in (red, green, blue):
+        channel_func = channel_func or func
+        if channel_func is None:
+            rows.append(LUT_INPUT)
+        else:
+            rows.append(np.broadcast_to(channel_func(LUT_INPUT), LUT_INPUT.shape))
+    lut = np.clip(np.stack(rows), 0, 255).astype('uint8')
+    lut.flags.writeable = False
+    return lut
+
+def compose_luts(*luts):
+    """
+    Collapses a chain of tables into one, first table applied first.
+    :param luts: uint8 arrays (3, 256)
+    :return: uint8 array (3, 256)
+    """
+    result = luts[0]
+    for lut in luts[1:]:
+        result = np.take_along_axis(lut, result.astype(np.intp), axis=1)
+    return result
+
+def apply_lut(image, *luts):
+    """
+    Applies one or more lookup tables in a single pass.
+    :param image: PIL Image. 'L' images stay 'L' when every channel of the
+                  table is the same; everything else is converted to RGB.
+    :param luts: uint8 arrays (3, 256), applied in order
+    :return: PIL Image
+    """
+    lut = compose_luts(*luts)
+    if image.mode == 'L' and (lut == lut[0]).all():
+        return image.point(lut[0].tolist())
+    return image.convert('RGB').point(lut.ravel().tolist())
+
+@lru_cache(maxsize=64)
+def green_tint_lut(factor=1.05):
+    """Table for add_green_tint: scales the green channel."""
+    return make_lut(green=lambda v: v.astype(np.float32) * factor)
+
+@lru_cache(maxsize=8)
+def posterize_lut(bits=3):
+    """Table matching ImageOps.posterize(img, bits)."""
+    return make_lut(lambda v: v.astype(np.intp) & ~(2 ** (8 - bits) - 1))
+
+@lru_cache(maxsize=256)
+def threshold_lut(level=180):
+    """Table mapping values above level to 255 and the rest to 0."""
+    return make_lut(lambda v: np.where(v > level, 255, 0))
+
+@lru_cache(maxsize=64)
+def bright_pass_lut(threshold=180, knee=0):
+    """
+    Table for add_halation's bright pass: threshold_lut(threshold) when knee
+    is 0, otherwise a smoothstep from 0 to 255 over threshold +- knee.
+    """
+    if knee == 0:
+        return threshold_lut(threshold)
+
+    def ramp(v):
+        t = np.clip((v - (threshold - knee)) / (2 * knee), 0, 1)
+        return 255 * t * t * (3 - 2 * t)
+    return make_lut(ramp)
+
+@lru_cache(maxsize=64)
+def tint_lut(tint):
+    """Table scaling each channel by tint / 255, e.g. to color a gray glow."""
+    return make_lut(red=lambda v: v * tint[0] / 255, green=lambda v: v * tint[1] / 255,
+                    blue=lambda v: v * tint[2] / 255)
+
+VHS_LINE_COLOR = (255, 0, 0, 80)
+
+@lru_cache(maxsize=1)
+def vhs_line_lut():
+    """Table matching Image.alpha_composite of VHS_LINE_COLOR over an opaque pixel."""
+    ramp = Image.fromarray(np.repeat(LUT_INPUT.astype(np.uint8), 3).reshape(1, 256, 3))
+    line = Image.new("RGBA", ramp.size, VHS_LINE_COLOR)
+    lut = np.asarray(Image.alpha_composite(ramp.convert("RGBA"), line).convert("RGB"))[0].T.copy()
+    lut.flags.writeable = False
+    return lut
+
+@lru_cache(maxsize=1)
+def invert_lut():
+    """Table matching ImageOps.invert."""
+    return make_lut(lambda v: 255 - v)
+
+@lru_cache(maxsize=1)
+def cross_processing_lut():
+    """Table for apply_cross_processing, computed in float32 like the array version."""
+    def curve(gamma):
+        return lambda v: np.power((v / 255.0).astype(np.float32), gamma) * 255
+    return make_lut(
+        red=lambda v: (v / 255.0).astype(np.float32) * 1.1 * 255,
+        green=curve(0.9),
+        blue=curve(0.8),
+    )
+
+############################
+# 17. Color Matrices
+############################
+# Linear color operations (saturation, brightness, channel gains, contrast,
+# the sepia matrix) as float32 arrays of shape (3, 4): out = M[:, :3] @ rgb
+# + M[:, 3]. A chain of them multiplies into one matrix, which PIL applies to
+# the image in a single convert() pass instead of one ImageEnhance blend,
+# and one full-size degenerate image, per operation. Results are truncated
+# to uint8 like ImageEnhance.
+#
+# Fusing skips the clipping ImageEnhance does between operations. That
+# matters most for gains and brightness, which push highlights past 255, so
+# the per-channel operations at the start of a chain are applied as a
+# lookup table first (which clips), and only the rest as a matrix.
+#
+# Contrast pivots on the mean luminance of its input, so it is only known
+# per image: ColorOp(None, factor) stands for it in a chain, and
+# color_chain takes the mean from a small box-downsampled proxy of the image
+# with the earlier operations applied.
+LUMA_WEIGHTS = np.array([0.299, 0.587, 0.114], dtype=np.float32)
+IDENTITY_MATRIX = np.hstack([np.eye(3), np.zeros((3, 1))]).astype(np.float32)
+COLOR_PROXY_SIZE = 256
+
+# One link of a color chain: a (3, 4) matrix, or a contrast factor
+ColorOp = namedtuple("ColorOp", "matrix contrast", defaults=(None,))
+
+def color_matrix(linear, offset=0.0):
+    """
+    :param linear: (3, 3) array applied to (r, g, b)
+    :param offset: Added to every channel, or one value per channel
+    :return: float32 array (3, 4)
+    """
+    offset = np.broadcast_to(np.asarray(offset, dtype=np.float64), (3,))
+    return np.hstack([np.asarray(linear, dtype=np.float64), offset[:, None]]).astype(np.float32)
+
+def compose_color_matrices(*matrices):
+    """
+    Collapses a chain of matrices into one, first matrix applied first.
+    :param matrices: float32 arrays (3, 4)
+    :return: float32 array (3, 4)
+    """
+    result = IDENTITY_MATRIX
+    for matrix in matrices:
+        result = color_matrix(matrix[:, :3] @ result[:, :3], matrix[:, :3] @ result[:, 3] + matrix[:, 3])
+    return result
+
+def saturation_matrix(factor):
+    """Matrix matching ImageEnhance.Color(img).enhance(factor)."""
+    return color_matrix(factor * np.eye(3) + (1 - factor) * np.outer(np.ones(3), LUMA_WEIGHTS))
+
+def brightness_matrix(factor):
+    """Matrix matching ImageEnhance.Brightness(img).enhance(factor)."""
+    return color_matrix(factor * np.eye(3))
+
+def gain_matrix(red=1.0, green=1.0, blue=1.0):
+    """Matrix scaling each channel on its own."""
+    return color_matrix(np.diag([red, green, blue]))
+
+def contrast_matrix(factor, mean):
+    """Matrix matching ImageEnhance.Contrast(img).enhance(factor) for an image of the given mean luminance."""
+    return color_matrix(factor * np.eye(3), (1 - factor) * mean)
+
+# The sepia weights as apply_sepia has always used them: np.dot(rgb, weights),
+# i.e. the transpose of the usual sepia matrix
+SEPIA_MATRIX = color_matrix(np.transpose([[0.272, 0.534, 0.131],
+                                          [0.349, 0.686, 0.168],
+                                          [0.393, 0.769, 0.189]]))
+
+def color_proxy(image, shared=None):
+    """
+    Box-downsampled copy of image, at most COLOR_PROXY_SIZE pixels on its
+    longest side, for image statistics.
+    :param image: PIL Image
+    :param shared: Optional dict for the source image, see apply_filter
+    :return: float32 array (H, W, 3)
+    """
+    if shared is not None and "color_proxy" in shared:
+        return shared["color_proxy"]
+    if image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    factor = math.ceil(max(image.size) / COLOR_PROXY_SIZE)
+    if factor > 1:
+        image = image.reduce(factor)
+    proxy = np.asarray(image.convert("RGB"), dtype=np.float32)
+    if shared is not None:
+        shared["color_proxy"] = proxy
+    return proxy
+
+def mean_luma(proxy, matrix=IDENTITY_MATRIX):
+    """
+    :param proxy: float32 array (H, W, 3) from color_proxy
+    :param matrix: Applied to the proxy first, clipped and truncated
+    :return: Mean luminance, rounded like ImageEnhance.Contrast
+    """
+    pixels = np.floor(np.clip(proxy @ matrix[:, :3].T + matrix[:, 3], 0, 255))
+    return float(int((pixels @ LUMA_WEIGHTS).mean() + 0.5))
+
+def color_chain_matrix(ops, proxy=None):
+    """
+    :param ops: List of ColorOp, applied in order
+    :param proxy: color_proxy of the chain's input; only needed for contrast ops
+    :return: float32 array (3, 4)
+    """
+    matrix = IDENTITY_MATRIX
+    for op in ops:
+        op_matrix = op.matrix
+        if op_matrix is None:
+            op_matrix = contrast_matrix(op.contrast, mean_luma(proxy, matrix))
+        matrix = compose_color_matrices(matrix, op_matrix)
+    return matrix
+
+def split_color_chain(ops):
+    """
+    :param ops: List of ColorOp
+    :return: (lookup table for the per-channel ops at the start of the chain,
+             or None; list of the remaining ops)
+    """
+    count = 0
+    for op in ops:
+        if op.matrix is None or np.count_nonzero(op.matrix[:, :3] - np.diag(np.diag(op.matrix[:, :3]))):
+            break
+        count += 1
+    if count == 0:
+        return None, ops
+    matrix = color_chain_matrix(ops[:count]).astype(np.float64)
+    scale, offset = np.diag(matrix[:, :3]), matrix[:, 3]
+    lut = make_lut(red=lambda v: v * scale[0] + offset[0],
+                   green=lambda v: v * scale[1] + offset[1],
+                   blue=lambda v: v * scale[2] + offset[2])
+    return lut, ops[count:]
+
+def color_chain(ops, image=None, shared=None):
+    """
+    Prepares a chain of ColorOps for apply_color_chain.
+    :param ops: List of ColorOp, applied in order
+    :param image: PIL Image the chain is for; only read for contrast ops
+    :param shared: Optional dict for image, see apply_filter
+    :return: (lookup table or None, matrix or None)
+    """
+    lut, ops = split_color_chain(ops)
+    if not ops:
+        return lut, None
+    proxy = None
+    if any(op.matrix is None for op in ops):
+        proxy = color_proxy(image, shared)
+        if lut is not None:
+            proxy = lut[np.arange(3), proxy.astype(np.intp)].astype(np.float32)
+    return lut, color_chain_matrix(ops, proxy)
+
+def apply_color_matrix(image, matrix):
+    """
+    Applies a color matrix in one pass.
+    :param image: PIL Image, converted to RGB
+    :param matrix: float32 array (3, 4)
+    :return: PIL Image
+    """
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    # PIL rounds; shift by half a level to truncate like ImageEnhance
+    truncating = matrix.astype(np.float64) - [0, 0, 0, 0.5]
+    return image.convert('RGB', tuple(truncating.ravel().tolist()))
+
+def apply_color_chain(image, lut, matrix):
+    """
+    :param image: PIL Image
+    :param lut: Table from color_chain, or None
+    :param matrix: Matrix from color_chain, or None
+    :return: PIL Image
+    """
+    if lut is not None:
+        image = apply_lut(image, lut)
+    if matrix is not None:
+        image = apply_color_matrix(image, matrix)
+    return image
+
+def apply_color_ops(image, ops, shared=None):
+    """
+    Applies a chain of ColorOps, in one pass where the chain allows.
+    :param image: PIL Image
+    :param ops: List of ColorOp, applied in order
+    :param shared: Optional dict for image, see apply_filter
+    :return: PIL Image
+    """
+    return apply_color_chain(image, *color_chain(ops, image, shared))
+
+# The chains of apply_sepia and apply_lomo
+SEPIA_OPS = [ColorOp(saturation_matrix(0.7)), ColorOp(SEPIA_MATRIX)]
+LOMO_OPS = [ColorOp(saturation_matrix(1.1)), ColorOp(None, 1.05), ColorOp(gain_matrix(green=1.05))]
+
+############################
+# 18. Digicam Preset (fused)
+############################
+def render_digicam(img, green_tint=1.023, brightness=1.2, saturation=1.95,
+                   contrast=1.15, grain_intensity=45, grain_offset=20,
+                   vignette_radius_factor=1.7, vignette_strength=0.3,
+                   halation_radius=5, halation_intensity=0.1,
+                   leak_count=2, leak_alpha=0.05, final_saturation=1.05, rng=None,
+                   budget=None):
+    """
+    The "digicam" look computed on a single float32 buffer.
+
+    Does the same work as chaining add_green_tint, the Brightness/Color/Contrast
+    enhancers, add_film_grain, apply_vignette, add_halation, add_light_leaks and
+    a final Color enhancer, but converts PIL -> NumPy once, updates the buffer
+    in place and converts back once. Only the luminance plane and the
+    halation glow are allocated next to it.
+
+    Tolerance: given the same random generator, the result differs from
+    the original staged chain by under 1 level mean absolute error (at
+    most about 0.8 levels of overall darkening) and by at most 3 levels
+    for 99% of pixels. The vignette uses apply_vignette's own mask, which
+    is built at reduced scale (see vignette_circle). The color stages are
+    fused (see Color Matrices) and the contrast pivot comes from a
+    downsampled proxy. The few larger differences, up to about 17 levels,
+    sit on the halation threshold and on the anti-aliased rims of the leak
+    circles.
+    The leaks are blended as an overlay that is black outside the circles,
+    so the frame is also dimmed by leak_alpha; add_light_leaks on its own
+    only changes the circles.
+
+    Frames whose working set would exceed the memory budget are rendered in
+    horizontal strips (see map_strips), each with a halo of rows for the
+    halation blur. The output is the same as rendering the whole frame.
+    :param img: PIL Image
+    :param rng: numpy Generator from make_rng, or None for a fresh one
+    :param budget: Working memory limit in bytes, default TILE_MEMORY_BUDGET
+    :return: PIL Image
+    """
+    if rng is None:
+        rng = make_rng()
+    width, height = img.size
+    tile = grain_tile(grain_intensity, grain_offset, rng)[..., None]
+    tile = np.repeat(tile.astype(np.float32), 3, axis=2)
+    leaks = random_light_leaks(img.size, leak_count, rng)
+
+    # 1) Green tint and brightness as one table, saturation and contrast as
+    #    one color matrix, contrast pivoting on the mean luminance of a
+    #    downsampled proxy
+    with stage("contrast"):
+        lut, matrix = color_chain([ColorOp(gain_matrix(green=green_tint)), ColorOp(brightness_matrix(brightness)),
+                                   ColorOp(saturation_matrix(saturation)), ColorOp(None, contrast)], img)
+
+    def later_stages(buf, luma, top):
+        rows = buf.shape[0]
+
+        # 2) Film grain, shared by all three channels and lined up with the
+        #    frame's tile grid whatever strip this is
+        with stage("grain"):
+            shifted = np.roll(tile, -top, axis=0) if top else tile
+            for y, x, h, w in grain_blocks(rows, width):
+                buf[y:y + h, x:x + w] += shifted[:h, :w]
+            np.clip(buf, 0, 255, out=buf)
+
+        # 3) Vignette
+        with stage("vignette"):
+            mask = vignette_rows(width, height, vignette_radius_factor, vignette_strength, top, top + rows)
+            gain = 255 - np.asarray(mask, dtype=np.float32)
+            gain *= np.float32(1 / 255)
+            buf *= gain[..., None]
+            np.floor(buf, out=buf)
+
+        # 4) Halation: blur the bright pass once, on a single plane
+        with stage("halation"):
+            np.matmul(buf, LUMA_WEIGHTS, out=luma)
+            bright = Image.fromarray(((luma > 180) * 255).astype('uint8'), mode='L')
+            glow = np.asarray(gaussian_blur(bright, halation_radius), dtype=np.float32)
+
+        # 5) Halation and light leak blends folded into one scale + add
+        with stage("leaks"):
+            keep = (1 - halation_intensity) * (1 - leak_alpha)
+            buf *= keep
+            glow *= halation_intensity * (1 - leak_alpha)
+            buf += glow[..., None]
+            np.floor(buf, out=buf)
+            _add_light_leaks(buf, [(x, y - top, radius, color) for x, y, radius, color in leaks],
+                             leak_alpha)
+
+        # 6) Final saturation push
+        with stage("saturation"):
+            _scale_saturation(buf, luma, final_saturation)
+
+    def load(top, bottom):
+        strip = img if bottom - top == height else img.crop((0, top, width, bottom))
+        with stage("color"):
+            strip = apply_color_chain(strip, lut, matrix)
+        with stage("load"):
+            buf = np.asarray(strip, dtype=np.float32)
+            return buf, np.empty(buf.shape[:2], dtype=np.float32)
+
+    halo = blur_halo(halation_radius)
+    rows = strip_rows(width, height, DIGICAM_BYTES_PER_PIXEL, halo, budget, blur_factor(halation_radius))
+    if rows >= height:
+        buf, luma = load(0, height)
+        later_stages(buf, luma, 0)
+        return Image.fromarray(buf.astype('uint8'))
+
+    out = Image.new('RGB', img.size)
+    for top, bottom, y0, y1 in strips(height, rows, halo):
+        buf, luma = load(y0, y1)
+        later_stages(buf, luma, y0)
+        out.paste(Image.fromarray(buf[top - y0:bottom - y0].astype('uint8')), (0, top))
+    return out
+
+# Working set of render_digicam per pixel: the float32 buffer, luminance and
+# glow planes, vignette rows and the uint8 input and output
+DIGICAM_BYTES_PER_PIXEL = 48
+
+def _scale_saturation(buf, luma, factor):
+    """
+    In-place equivalent of ImageEnhance.Color on a float32 RGB buffer.
+    :param buf: float32 (H, W, 3) array, modified in place
+    :param luma: float32 (H, W) scratch array
+    :param factor: Saturation factor (1.0 = no change)
+    """
+    np.matmul(buf, LUMA_WEIGHTS, out=luma)
+    buf -= luma[..., None]
+    buf *= factor
+    buf += luma[..., None]
+    np.clip(buf, 0, 255, out=buf)
+    np.floor(buf, out=buf)
+
+def _add_light_leaks(buf, leaks, alpha):
+    """
+    Adds light leak circles into a float32 RGB buffer, touching only each
+    circle's bounding box. Where circles overlap the later one covers the
+    earlier, the same as drawing them onto one overlay.
+    :param buf: float32 (H, W, 3) array, modified in place
+    :param leaks: List of (x, y, radius, color) from random_light_leaks
+    :param alpha: Blend factor
+    """
+    height, width = buf.shape[:2]
+    for i, (x, y, radius, color) in enumerate(leaks):
+        window = disc_window(x, y, radius, (width, height))
+        if window is None:
+            continue
+        (rows, cols), mask = window
+        weight = np.asarray(mask, dtype=np.float32) / 255
+        for lx, ly, lradius, _ in leaks[i + 1:]:
+            overlap = disc_window(lx - cols.start, ly - rows.start, lradius, mask.size)
+            if overlap is not None:
+                (orows, ocols), cover = overlap
+                weight[orows, ocols] *= 1 - np.asarray(cover, dtype=np.float32) / 255
+        buf[rows, cols] += weight[..., None] * (np.asarray(color, dtype=np.float32) * alpha)
+
+############################
+# 19. Blurs
+############################
+# gaussian_blur stands in for image.filter(ImageFilter.GaussianBlur(radius)).
+# PIL's blur costs the same per pixel at any radius, but a large blur is
+# smooth enough to compute at lower resolution: from BLUR_PYRAMID_RADIUS up,
+# the image is box-reduced by a power of two k (leaving at least
+# BLUR_REDUCED_RADIUS of blur at the small scale), blurred there and
+# bilinearly upsampled, so the blur itself runs on 1/k^2 of the pixels.
+# Reducing and upsampling blur a little themselves, so the small blur's
+# radius is trimmed to keep the total the same.
+#
+# Error against PIL's GaussianBlur on 12 MP photos: up to radius 50, at most
+# 4 levels and 99% of pixels within 2; up to radius 200, 99% within 6. On
+# hard 0/255 masks single pixels next to an edge can be up to 15 levels
+# off. Below BLUR_PYRAMID_RADIUS the result is PIL's. The vignette mask is
+# built at the reduced scale the same way, see vignette_circle.
+BLUR_PYRAMID_RADIUS = 12
+BLUR_REDUCED_RADIUS = 6
+
+def blur_factor(radius):
+    """
+    :return: Factor gaussian_blur(radius) downsamples by: 1, or a power of two
+    """
+    factor = 1
+    if radius >= BLUR_PYRAMID_RADIUS:
+        while radius / (2 * factor) >= BLUR_REDUCED_RADIUS:
+            factor *= 2
+    return factor
+
+def _reduced_radius(radius, factor):
+    # The box reduce adds about factor^2 / 12 of variance, the bilinear
+    # upsampling about factor^2 / 6
+    return math.sqrt(max(radius ** 2 - factor ** 2 / 4, 0)) / factor
+
+def gaussian_blur(image, radius):
+    """
+    Gaussian blur, edges extended, through the pyramid for large radii.
+    :param image: PIL Image ('L', 'RGB' or 'RGBA')
+    :param radius: Standard deviation in pixels, as for ImageFilter.GaussianBlur
+    :return: PIL Image
+    """
+    factor = blur_factor(radius)
+    if factor == 1:
+        return image.filter(ImageFilter.GaussianBlur(radius))
+    width, height = image.size
+    small = image.reduce(factor).filter(ImageFilter.GaussianBlur(_reduced_radius(radius, factor)))
+    # The box keeps the scale exactly 1 / factor, whatever the size, so a
+    # strip starting on a multiple of factor lines up with the whole frame
+    return small.resize(image.size, Image.BILINEAR, box=(0, 0, width / factor, height / factor))
+
+def blur_halo(radius):
+    """
+    Rows of context gaussian_blur(radius) reads on each side, a multiple of
+    blur_factor(radius). PIL runs three box blurs, each at most
+    ceil(radius) + 1 pixels wide; the pyramid reads those at the reduced
+    scale, plus one reduced row for the upsampling and one for a partial
+    block at the strip's end.
+    """
+    factor = blur_factor(radius)
+    if factor == 1:
+        return 3 * (int(math.ceil(radius)) + 1)
+    return factor * (3 * (int(math.ceil(_reduced_radius(radius, factor))) + 1) + 2)
+
+############################
+# 20. Tiled Processing
+############################
+# Large frames are processed in horizontal strips so the float32 and
+# blurred temporaries of one strip, not of the whole frame, bound the
+# working memory. Blurs get a halo of extra rows on each side, wide enough
+# that rows inside the strip come out exactly as in a whole-frame pass.
+TILE_MEMORY_BUDGET = int(os.environ.get("TILE_MEMORY_BUDGET", 512 * 1024 * 1024))
+STRIP_MIN_ROWS = 16
+
+def strip_rows(width, height, bytes_per_pixel, halo=0, budget=None, align=1):
+    """
+    :param width: Frame width
+    :param height: Frame height
+    :param bytes_per_pixel: Working memory the filter needs per pixel
+    :param halo: Extra rows read on each side of a strip
+    :param budget: Working memory limit in bytes, default TILE_MEMORY_BUDGET
+    :param align: Strips start on multiples of this (see blur_factor); the
+                  halo must be a multiple of it too
+    :return: Rows per strip; height when the whole frame fits
+    """
+    if budget is None:
+        budget = TILE_MEMORY_BUDGET
+    if width * height * bytes_per_pixel <= budget:
+        return height
+    rows = max(budget // (width * bytes_per_pixel) - 2 * halo, STRIP_MIN_ROWS, align)
+    return min(rows - rows % align, height)
+
+def strips(height, rows, halo=0):
+    """
+    Yields (top, bottom, halo_top, halo_bottom) for each strip of rows.
+    """
+    for top in range(0, height, rows):
+        bottom = min(top + rows, height)
+        yield top, bottom, max(top - halo, 0), min(bottom + halo, height)
+
+def map_strips(image, func, halo=0, bytes_per_pixel=16, budget=None, align=1):
+    """
+    Applies func to the whole image, or strip by strip when that would
+    exceed the memory budget.
+    :param image: PIL Image
+    :param func: func(strip, top) -> PIL Image the size of strip, where top
+                 is the row of the image the strip starts at
+    :param halo: Rows of context func needs on each side
+    :param bytes_per_pixel: Working memory func needs per pixel
+    :param budget: Working memory limit in bytes, default TILE_MEMORY_BUDGET
+    :param align: See strip_rows
+    :return: PIL Image
+    """
+    width, height = image.size
+    rows = strip_rows(width, height, bytes_per_pixel, halo, budget, align)
+    if rows >= height:
+        return func(image, 0)
+    out = None
+    for top, bottom, y0, y1 in strips(height, rows, halo):
+        result = func(image.crop((0, y0, width, y1)), y0)
+        if out is None:
+            out = Image.new(result.mode, image.size)
+        out.paste(result.crop((0, top - y0, width, bottom - y0)), (0, top))
+    return out
+
+############################
+# 21. Effect Registry
+############################
+# Every effect a pipeline can use, by name. An effect is registered with the
+# parameters it takes, each a Param(kind, default, low, high) where kind is
+# "int", "float", "color" (an [r, g, b] list), "font" (a key of FONTS) or
+# "point" (an [x, y] list). Parameters whose default is None are optional.
+#
+# The registered function is the effect's setup: it is called once, when a
+# pipeline is compiled, with every parameter filled in, and returns
+# step(img, ctx) -> PIL Image, a ColorOp (or list of them) for linear color
+# effects, or a lookup table for other point-wise ones. Adjacent color ops
+# are fused into one matrix, and adjacent tables into one table, at compile
+# time. ctx carries the request's rng, stamp_text and shared dict (see
+# PipelineContext).
+Param = namedtuple("Param", "kind default low high", defaults=(None, None))
+Effect = namedtuple("Effect", "setup params random stamped")
+
+EFFECTS = {}
+
+def effect(name, random=False, stamped=False, **params):
+    """
+    Registers the decorated setup function as effect name.
+    :param random: The effect draws from ctx.rng
+    :param stamped: The effect draws the date stamp from ctx.stamp_text
+    :param params: Parameter name -> Param
+    """
+    def register(setup):
+        EFFECTS[name] = Effect(setup, params, random, stamped)
+        return setup
+    return register
+
+def check_grain(intensity, offset):
+    """
+    Grain values span [-offset, intensity - offset) and must fit in int8.
+    :raises ValueError: otherwise
+    """
+    if not 0 < intensity - offset <= 128 or offset > 128:
+        raise ValueError("grain needs offset <= 128 and 0 < intensity - offset <= 128")
+
+@effect("grain", random=True, intensity=Param("int", 50, 1, 255), offset=Param("int", 25, 0, 128))
+def _grain_effect(intensity, offset):
+    check_grain(intensity, offset)
+    return lambda img, ctx: add_film_grain(img, intensity, offset, rng=ctx.rng)
+
+@effect("light_leaks", random=True, leak_count=Param("int", 5, 0, 50), alpha=Param("float", 0.25, 0, 1),
+        feather=Param("float", 1.0, 0, 100))
+def _light_leaks_effect(leak_count, alpha, feather):
+    return lambda img, ctx: add_light_leaks(img, leak_count, alpha, feather, rng=ctx.rng)
+
+@effect("vignette", radius_factor=Param("float", 1.6, 0.1, 10), strength=Param("float", 0.7, 0, 1))
+def _vignette_effect(radius_factor, strength):
+    return lambda img, ctx: apply_vignette(img, radius_factor, strength)
+
+@effect("sepia")
+def _sepia_effect():
+    return SEPIA_OPS
+
+@effect("cross_process")
+def _cross_process_effect():
+    return cross_processing_lut()
+
+@effect("lomo")
+def _lomo_effect():
+    return lambda img, ctx: apply_lomo(img)
+
+@effect("chromatic_aberration", shift=Param("float", 5, -100, 100))
+def _chromatic_aberration_effect(shift):
+    return lambda img, ctx: add_chromatic_aberration(img, shift)
+
+@effect("halation", blur_radius=Param("float", 15, 0, 100), intensity=Param("float", 0.4, 0, 1),
+        threshold=Param("int", 180, 0, 255), knee=Param("int", 0, 0, 128),
+        tint=Param("color", (255, 255, 255)))
+def _halation_effect(blur_radius, intensity, threshold, knee, tint):
+    return lambda img, ctx: add_halation(img, blur_radius, intensity, threshold, knee, tint)
+
+# add_dust_and_scratches is not an op: it needs a texture file the caller
+# provides, and none ships with the server
+
+@effect("stamp", stamped=True, padding=Param("int", 50, 0, 2000), font_size=Param("int", 52, 6, 500),
+        color=Param("color", (255, 222, 33)), font=Param("font", "default"))
+def _stamp_effect(padding, font_size, color, font):
+    return lambda img, ctx: add_date_stamp_bottom_right(img, ctx.stamp_text, padding, font_size,
+                                                        color, font)
+
+@effect("polaroid", frame_width=Param("int", 50, 0, 1000), bottom_extra=Param("int", 30, 0, 1000),
+        background_color=Param("color", (255, 255, 255)))
+def _polaroid_effect(frame_width, bottom_extra, background_color):
+    return lambda img, ctx: add_polaroid_frame(img, frame_width, bottom_extra, background_color)
+
+@effect("vhs", random=True, line_height=Param("int", 2, 1, 100),
+        glitch_strength=Param("int", 10, 0, 1000), alpha=Param("float", 0.3, 0, 1),
+        displacement=Param("int", 0, 0, 1000))
+def _vhs_effect(line_height, glitch_strength, alpha, displacement):
+    return lambda img, ctx: add_vhs_glitch(img, line_height, glitch_strength, alpha, displacement,
+                                           rng=ctx.rng)
+
+# Random only for the flare position, drawn when center is not given
+@effect("lens_flare", random=True, center=Param("point", None), radius=Param("int", 80, 1, 2000),
+        color=Param("color", (255, 255, 200)), intensity=Param("float", 0.4, 0, 1),
+        feather=Param("float", 1.0, 0, 100))
+def _lens_flare_effect(center, radius, color, intensity, feather):
+    return lambda img, ctx: add_lens_flare(img, center, radius, color, intensity, feather,
+                                           rng=ctx.rng)
+
+@effect("tilt_shift", blur_strength=Param("float", 15, 0, 100),
+        focus_center=Param("int", None, 0, 100000), focus_height=Param("int", 100, 0, 100000))
+def _tilt_shift_effect(blur_strength, focus_center, focus_height):
+    return lambda img, ctx: apply_tilt_shift(img, blur_strength, focus_center, focus_height)
+
+@effect("green_tint", factor=Param("float", 1.05, 0, 4))
+def _green_tint_effect(factor):
+    return ColorOp(gain_matrix(green=factor))
+
+@effect("posterize", bits=Param("int", 3, 1, 8))
+def _posterize_effect(bits):
+    return posterize_lut(bits)
+
+@effect("invert")
+def _invert_effect():
+    return invert_lut()
+
+@effect("brightness", factor=Param("float", 1.5, 0, 10))
+def _brightness_effect(factor):
+    return ColorOp(brightness_matrix(factor))
+
+@effect("contrast", factor=Param("float", 2.0, 0, 10))
+def _contrast_effect(factor):
+    return ColorOp(None, factor)
+
+@effect("saturation", factor=Param("float", 2.0, 0, 10))
+def _saturation_effect(factor):
+    return ColorOp(saturation_matrix(factor))
+
+@effect("digicam", random=True,
+        green_tint=Param("float", 1.023, 0, 4), brightness=Param("float", 1.2, 0, 10),
+        saturation=Param("float", 1.95, 0, 10), contrast=Param("float", 1.15, 0, 10),
+        grain_intensity=Param("int", 45, 1, 255), grain_offset=Param("int", 20, 0, 128),
+        vignette_radius_factor=Param("float", 1.7, 0.1, 10), vignette_strength=Param("float", 0.3, 0, 1),
+        halation_radius=Param("float", 5, 0, 100), halation_intensity=Param("float", 0.1, 0, 1),
+        leak_count=Param("int", 2, 0, 50), leak_alpha=Param("float", 0.05, 0, 1),
+        final_saturation=Param("float", 1.05, 0, 10))
+def _digicam_effect(**params):
+    check_grain(params["grain_intensity"], params["grain_offset"])
+    return lambda img, ctx: render_digicam(img, rng=ctx.rng, **params)
+
+############################
+# 22. Pipelines
+############################
+# A pipeline spec is JSON: {"ops": [{"op": <effect name>, "params": {...}}, ...]},
+# applied in order. compile_pipeline validates a spec and runs the effects'
+# setup, giving a Plan. Plans are cached by the SHA-256 of the spec's
+# canonical JSON, so a repeated spec (every preset) skips both.
+PIPELINE_MAX_OPS = 16
+PIPELINE_CACHE_SIZE = 256
+
+class PipelineContext:
+    """
+    What the steps of one run share. The rng is created on first use, so a
+    pipeline draws from a single make_rng(seed) stream in op order.
+    """
+
+    def __init__(self, seed=None, stamp_text=None, shared=None):
+        self.seed = seed
+        self.stamp_text = stamp_text
+        self.shared = shared
+        self._rng = None
+
+    @property
+    def rng(self):
+        if self._rng is None:
+            self._rng = make_rng(self.seed)
+        return self._rng
+
+class Plan:
+    """
+    A compiled pipeline: a list of (name, step) plus what the result
+    depends on.
+    """
+
+    def __init__(self, key, steps, random, stamped):
+        self.key = key
+        self.steps = steps
+        self.random = random
+        self.stamped = stamped
+
+    def run(self, img, seed=None, stamp_text=None, shared=None):
+        """
+        :param img: PIL Image
+        :param seed: Makes the random ops repeatable
+        :param stamp_text: Date stamp text, defaults to the current minute
+        :param shared: See apply_filter; only the first step sees it, since
+                       it describes the source image
+        :return: PIL Image
+        """
+        ctx = PipelineContext(seed, stamp_text, shared)
+        for index, (name, step) in enumerate(self.steps):
+            if index == 1:
+                ctx.shared = None
+            with stage(name):
+                img = step(img, ctx)
+        return img
+
+def compile_pipeline(spec):
+    """
+    :param spec: Pipeline spec (dict), or the name of a PRESETS entry
+    :return: Plan, shared by every call with the same spec
+    :raises ValueError: if the spec is invalid
+    """
+    if isinstance(spec, str):
+        if spec not in PRESETS:
+            raise ValueError("Unsupported filter type.")
+        spec = PRESETS[spec]
+    try:
+        canonical = json.dumps(spec, sort_keys=True, separators=(",", ":"), allow_nan=False)
+    except (TypeError, ValueError):
+        raise ValueError("pipeline must be plain JSON")
+    return _compile_pipeline(hashlib.sha256(canonical.encode("utf-8")).hexdigest(), canonical)
+
+@lru_cache(maxsize=PIPELINE_CACHE_SIZE)
+def _compile_pipeline(key, canonical):
+    spec = json.loads(canonical)
+    if not isinstance(spec, dict) or set(spec) != {"ops"} or not isinstance(spec["ops"], list):
+        raise ValueError('pipeline must be an object with one key, "ops", holding a list')
+    if not 0 < len(spec["ops"]) <= PIPELINE_MAX_OPS:
+        raise ValueError(f"pipeline must have 1 to {PIPELINE_MAX_OPS} ops")
+
+    steps = []
+    luts = []
+    colors = []
+    random = stamped = False
+    for index, op in enumerate(spec["ops"]):
+        where = f"ops[{index}]"
+        if not isinstance(op, dict) or "op" not in op or not set(op) <= {"op", "params"}:
+            raise ValueError(f'{where} must be an object with "op" and optional "params"')
+        name = op["op"]
+        if name not in EFFECTS:
+            raise ValueError(f"{where}: unknown op {name!r}")
+        entry = EFFECTS[name]
+        params = _validate_params(f"{where}.params", entry.params, op.get("params", {}))
+        try:
+            step = entry.setup(**params)
+        except ValueError as e:
+            raise ValueError(f"{where}: {e}")
+        random = random or entry.random
+        stamped = stamped or entry.stamped
+
+        if isinstance(step, (ColorOp, list)):
+            colors.append((name, step if isinstance(step, list) else [step]))
+            continue
+        _flush_colors(colors, luts, steps)
+        if isinstance(step, np.ndarray):
+            luts.append((name, step))
+            continue
+        _flush_luts(luts, steps)
+        steps.append((name, step))
+    _flush_colors(colors, luts, steps)
+    _flush_luts(luts, steps)
+    return Plan(key, steps, random, stamped)
+
+def _flush_colors(colors, luts, steps):
+    """
+    Turns a run of color ops into a table for the per-channel ops at its
+    start (joining any neighbouring tables) and one step for the rest. Each
+    is named after the effects whose ops it holds.
+    :param colors: List of (name, list of ColorOp); emptied
+    """
+    if not colors:
+        return
+    chain = [(index, op) for index, (_, run) in enumerate(colors) for op in run]
+    lut, ops = split_color_chain([op for _, op in chain])
+    split = len(chain) - len(ops)
+
+    def names(part):
+        return "+".join(colors[index][0] for index in sorted({index for index, _ in part}))
+
+    lut_name, name = names(chain[:split]), names(chain[split:])
+    colors.clear()
+    if lut is not None:
+        luts.append((lut_name, lut))
+    if not ops:
+        return
+    _flush_luts(luts, steps)
+    if all(op.matrix is not None for op in ops):
+        matrix = color_chain_matrix(ops)
+        steps.append((name, lambda img, ctx: apply_color_matrix(img, matrix)))
+    else:
+        steps.append((name, lambda img, ctx: apply_color_ops(img, ops, ctx.shared)))
+
+def _flush_luts(luts, steps):
+    """
+    Turns a run of lookup-table ops into one step applying a single table.
+    :param luts: List of (name, table); emptied
+    """
+    if not luts:
+        return
+    name = "+".join(name for name, _ in luts)
+    lut = compose_luts(*(table for _, table in luts))
+    luts.clear()
+    steps.append((name, lambda img, ctx: apply_lut(img, lut)))
+
+def _validate_params(where, schema, params):
+    """
+    :return: dict with every parameter of schema, defaults filled in
+    :raises ValueError: naming the first bad parameter
+    """
+    if not isinstance(params, dict):
+        raise ValueError(f"{where} must be an object")
+    unknown = set(params) - set(schema)
+    if unknown:
+        raise ValueError(f"{where}: unknown parameters {', '.join(sorted(unknown))}")
+    values = {}
+    for name, param in schema.items():
+        value = params.get(name, param.default)
+        if value is not None or param.default is not None:
+            value = _validate_param(f"{where}.{name}", param, value)
+        values[name] = value
+    return values
+
+def _validate_param(where, param, value):
+    if param.kind in ("int", "float"):
+        allowed = int if param.kind == "int" else (int, float)
+        if isinstance(value, bool) or not isinstance(value, allowed):
+            raise ValueError(f"{where} must be a{'n integer' if param.kind == 'int' else ' number'}")
+        if not param.low <= value <= param.high:
+            raise ValueError(f"{where} must be between {param.low} and {param.high}")
+        return value
+    if param.kind == "font":
+        if value not in FONTS:
+            raise ValueError(f"{where} must be one of {', '.join(FONTS)}")
+        return value
+    size, high = (3, 255) if param.kind == "color" else (2, 100000)
+    if (not isinstance(value, (list, tuple)) or len(value) != size
+            or not all(isinstance(v, int) and not isinstance(v, bool) and 0 <= v <= high for v in value)):
+        raise ValueError(f"{where} must be a list of {size} integers from 0 to {high}")
+    return tuple(value)
+
+############################
+# 23. Sprites
+############################
+# Small overlays (light leaks, the lens flare, the date stamp) are blended
+# into the image only inside their bounding box, through an 'L' mask
+# pasted with a fill color, so they cost the area they cover rather than
+# the frame size. Masks are cached; the color needs no rasterizing since
+# Image.paste fills it in. Discs are anti-aliased, with coverage falling
+# from 1 to 0 across a rim feather pixels wide. Only the part of a disc that
+# falls inside the frame is rasterized: discs up to SPRITE_CACHE_RADIUS come
+# from a cached sprite and are cropped, larger ones are computed for the
+# clipped window alone.
+SPRITE_CACHE_SIZE = int(os.environ.get("SPRITE_CACHE_SIZE", 64))
+SPRITE_CACHE_RADIUS = 256
+
+def disc_window(x, y, radius, bounds, opacity=1.0, feather=1.0):
+    """
+    The part of a disc centered on (x, y) that falls inside an area.
+    :param radius: Disc radius in pixels
+    :param bounds: (width, height) of the area
+    :param opacity: Mask value at the center, 0-1
+    :param feather: Width of the soft rim in pixels, 0 for a hard edge
+    :return: ((rows, cols) slices of the area, 'L' mask Image of that
+             window), or None when the disc misses the area
+    """
+    half = int(math.ceil(radius + feather / 2))
+    window = sprite_window(x - half, y - half, (2 * half + 1, 2 * half + 1), bounds)
+    if window is None:
+        return None
+    area, (rows, cols) = window
+    if radius <= SPRITE_CACHE_RADIUS:
+        mask = disc_sprite(radius, opacity, feather).crop((cols.start, rows.start, cols.stop, rows.stop))
+    else:
+        mask = _disc_mask(rows.start - half, rows.stop - half, cols.start - half, cols.stop - half,
+                          radius, opacity, feather)
+    return area, mask
+
+@lru_cache(maxsize=SPRITE_CACHE_SIZE)
+def disc_sprite(radius, opacity=1.0, feather=1.0):
+    """
+    Whole disc mask, for radii up to SPRITE_CACHE_RADIUS.
+    :return: 'L' Image, a square of odd side with the disc centered on the
+             middle pixel
+    """
+    half = int(math.ceil(radius + feather / 2))
+    return _disc_mask(-half, half + 1, -half, half + 1, radius, opacity, feather)
+
+def _disc_mask(top, bottom, left, right, radius, opacity, feather):
+    # Rows top..bottom and columns left..right, relative to the disc center
+    ys, xs = np.ogrid[top:bottom, left:right]
+    distance = np.sqrt((xs * xs + ys * ys).astype(np.float32))
+    if feather > 0:
+        coverage = np.clip((radius - distance) / feather + 0.5, 0, 1)
+    else:
+        coverage = (distance <= radius).astype(np.float32)
+    return Image.fromarray(np.rint(coverage * (opacity * 255)).astype(np.uint8), mode='L')
+
+def sprite_window(x, y, size, bounds):
+    """
+    Clips a sprite placed with its top-left corner at (x, y).
+    :param size: (width, height) of the sprite
+    :param bounds: (width, height) of the area it is placed on
+    :return: ((rows, cols) slices of the area, (rows, cols) slices of the
+             sprite), or None when they do not overlap
+    """
+    x0, y0 = max(x, 0), max(y, 0)
+    x1, y1 = min(x + size[0], bounds[0]), min(y + size[1], bounds[1])
+    if x0 >= x1 or y0 >= y1:
+        return None
+    return (slice(y0, y1), slice(x0, x1)), (slice(y0 - y, y1 - y), slice(x0 - x, x1 - x))
+
+def paste_sprite(image, mask, color, x, y):
+    """
+    Blends a solid color into the image through mask, with the mask's
+    top-left corner at (x, y). Only the mask's box is touched and Image.paste
+    clips it to the image.
+    :param image: PIL Image, modified in place
+    :param mask: 'L' Image
+    :param color: Fill color
+    """
+    image.paste(tuple(color), (x, y, x + mask.width, y + mask.height), mask)
+
+def paste_disc(image, x, y, radius, color, opacity=1.0, feather=1.0):
+    """
+    Blends a disc of color centered on (x, y) into the image in place.
+    """
+    window = disc_window(x, y, radius, image.size, opacity, feather)
+    if window is not None:
+        (rows, cols), mask = window
+        paste_sprite(image, mask, color, cols.start, rows.start)
+
+############################
+# Presets
+############################
+# The named filters clients pick with 'filter', as built-in pipeline specs
+PRESETS = {
+    "digicam": {"ops": [
+        {"op": "stamp", "params": {"padding": 100, "font_size": 122, "color": [255, 222, 33]}},
+        # Tint, enhance, grain, vignette, halation and leaks in one pass
+        {"op": "digicam"},
+    ]},
+    "sepia": {"ops": [{"op": "sepia"}]},
+    "invert": {"ops": [{"op": "invert"}]},
+    "brightness": {"ops": [{"op": "brightness", "params": {"factor": 1.5}}]},
+    "contrast": {"ops": [{"op": "contrast", "params": {"factor": 2.0}}]},
+    "saturate": {"ops": [{"op": "saturation", "params": {"factor": 2.0}}]},
+}
+
+FILTERS = list(PRESETS)
+
+def _presets_using(flag):
+    return {name for name, spec in PRESETS.items()
+            if any(getattr(EFFECTS[op["op"]], flag) for op in spec["ops"])}
+
+# Presets whose output depends on a random draw, or on the clock via the date stamp
+RANDOM_FILTERS = _presets_using("random")
+STAMPED_FILTERS = _presets_using("stamped")
+
+def current_stamp_text():
+    return datetime.now().strftime('%Y-%m-%d %H:%M')
+
+def is_repeatable(filter_type, seed=None):
+    """
+    Whether the same input always gives the same output, i.e. whether the
+    result may be cached. Random presets and pipelines need a seed for that.
+    :param filter_type: Preset name or validated pipeline spec
+    """
+    if seed is not None:
+        return True
+    if isinstance(filter_type, str):
+        return filter_type not in RANDOM_FILTERS
+    return not compile_pipeline(filter_type).random
+
+def is_stamped(filter_type):
+    """
+    Whether the output carries the date stamp, i.e. whether the stamp text
+    must be fixed up front (and made part of the cache key).
+    :param filter_type: Preset name or validated pipeline spec
+    """
+    if isinstance(filter_type, str):
+        return filter_type in STAMPED_FILTERS
+    return compile_pipeline(filter_type).stamped
+
+def apply_filter(img, filter_type, shared=None, seed=None, stamp_text=None):
+    """
+    Applies one of the FILTERS presets, or a pipeline spec.
+    :param img: PIL Image
+    :param filter_type: Name of the filter, or a pipeline spec (see compile_pipeline)
+    :param shared: Optional dict reused across calls on the same source image,
+                   so derived data (the proxy contrast is measured on) is
+                   only computed once
+    :param seed: Makes the random parts of the filter repeatable
+    :param stamp_text: Date stamp text, defaults to the current minute
+    :return: PIL Image
+    """
+    return compile_pipeline(filter_type).run(img, seed, stamp_text, shared)
+
+############################
+# Warm-up
+############################
+def warm_caches(sizes=((1280, 960), (1280, 1707))):
+    """
+    Pre-builds the cached data the presets use, so the first real request
+    in a fresh process does not pay for it.
+    :param sizes: (width, height) pairs to build vignette masks for
+    """
+    for width, height in sizes:
+        vignette_circle(width, height, 1.7)  # digicam
+        vignette_circle(width, height, 1.3)  # lomo
+    for char in "0123456789-: ":
+        glyph_sprite("default", 122, char)
+    invert_lut()
+    cross_processing_lut()
+    threshold_lut(180)
+    grain_textures(45, 20)  # digicam
+    for name in PRESETS:
+        compile_pipeline(name)
@@ -0,0 +1,165 @@
+import io
+import json
+from collections import namedtuple
+from PIL import Image, ImageOps
+from result_cache import result_cache_key
+from timing import stage
+
+############################
+# Decoding
+############################
+def open_image(stream, max_dimension=None):
+    """
+    Decodes an uploaded image and applies its EXIF orientation.
+
+    With max_dimension set, JPEGs are decoded at a reduced scale in the DCT
+    domain (Pillow draft mode) and then resized with LANCZOS so the longest
+    side is at most max_dimension. Decode time and memory then follow the
+    output size instead of the upload size. Other formats are decoded in full
+    and resized.
+    :param stream: File-like object with the image bytes
+    :param max_dimension: Longest side of the result in pixels, or None
+    :return: PIL Image
+    """
+    img = Image.open(stream)
+    original_format = img.format
+    if max_dimension:
+        # Picks the smallest 1/2, 1/4 or 1/8 scale still >= the requested size
+        img.draft(img.mode, (max_dimension, max_dimension))
+    img = ImageOps.exif_transpose(img)
+    if max_dimension and max(img.size) > max_dimension:
+        img.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+    img.format = original_format
+    return img
+
+############################
+# Request Parameters
+############################
+def parse_max_dimension(value):
+    """
+    Validates a max_dimension request parameter.
+    :param value: Raw parameter (str, int or None)
+    :return: Positive int, or None when the parameter is missing or empty
+    """
+    if value is None or value == "":
+        return None
+    try:
+        max_dimension = int(value)
+    except (TypeError, ValueError):
+        raise ValueError("max_dimension must be an integer")
+    if max_dimension <= 0:
+        raise ValueError("max_dimension must be positive")
+    return max_dimension
+
+def parse_seed(value):
+    """
+    Validates a seed request parameter.
+    :param value: Raw parameter (str, int or None)
+    :return: Non-negative int, or None when the parameter is missing or empty
+    """
+    if value is None or value == "":
+        return None
+    try:
+        seed = int(value)
+    except (TypeError, ValueError):
+        raise ValueError("seed must be an integer")
+    if seed < 0:
+        raise ValueError("seed must not be negative")
+    return seed
+
+def parse_pipeline(value):
+    """
+    Decodes and validates a pipeline request parameter.
+    :param value: JSON text, an already decoded spec, or None
+    :return: Pipeline spec, or None when the parameter is missing or empty
+    :raises ValueError: if it is not valid JSON or not a valid spec
+    """
+    if value is None or value == "":
+        return None
+    if isinstance(value, (str, bytes)):
+        try:
+            value = json.loads(value)
+        except ValueError:
+            raise ValueError("pipeline must be valid JSON")
+    from filters import compile_pipeline
+    compile_pipeline(value)
+    return value
+
+############################
+# Filter Requests
+############################
+# The steps every front end (server.py, asgi.py, the Lambda handler in
+# test.py) takes for one filter request, whatever shape its parameters
+# arrive in.
+FilterRequest = namedtuple('FilterRequest', 'filter_type max_dimension seed stamp_text')
+
+def parse_filter_request(filter_type=None, pipeline=None, max_dimension=None, seed=None):
+    """
+    Validates the parameters of a filter request.
+    :param filter_type: Name of the filter, or None
+    :param pipeline: Pipeline spec (JSON text or decoded), used in place of the filter
+    :param max_dimension: Raw max_dimension parameter
+    :param seed: Raw seed parameter
+    :return: FilterRequest
+    :raises ValueError: if no filter is given or a parameter is invalid
+    """
+    from filters import current_stamp_text, is_stamped
+
+    if not filter_type and not pipeline:
+        raise ValueError("No filter specified in the request")
+    filter_type = parse_pipeline(pipeline) or filter_type
+    max_dimension = parse_max_dimension(max_dimension)
+    seed = parse_seed(seed)
+    # Fix the stamp text up front so it is part of the cache key
+    stamp_text = current_stamp_text() if is_stamped(filter_type) else None
+    return FilterRequest(filter_type, max_dimension, seed, stamp_text)
+
+def cached_result(cache, source, filter_request, output=None):
+    """
+    Looks a request up in the result cache.
+    :param cache: Result cache (see result_cache.make_result_cache), or None
+    :param source: Input image bytes (or another stable identity as bytes),
+                   or a function returning them, called only if needed
+    :param filter_request: FilterRequest
+    :param output: Format the result is encoded as, or None for the input's
+    :return: (cache key, (data, image format) or None); the key is None when
+             there is no cache or the request is not repeatable
+    """
+    from filters import is_repeatable
+
+    if cache is None or not is_repeatable(filter_request.filter_type, filter_request.seed):
+        return None, None
+    with stage("cache"):
+        if callable(source):
+            source = source()
+        key = result_cache_key(source, filter_request.filter_type, max_dimension=filter_request.max_dimension,
+                               seed=filter_request.seed, stamp_text=filter_request.stamp_text, output=output)
+        return key, cache.get(key)
+
+def store_result(cache, key, data, image_format):
+    """
+    Stores an encoded result under a key from cached_result, if it gave one.
+    """
+    if key is not None:
+        with stage("cache"):
+            cache.put(key, data, image_format)
+
+def filter_and_encode(img, filter_type, seed=None, stamp_text=None, output=None):
+    """
+    Applies a filter to a decoded image and encodes the result.
+    :param img: PIL Image
+    :param filter_type: Name of the filter or a pipeline spec
+    :param seed: Optional seed for the random parts of the filter
+    :param stamp_text: Optional date stamp text
+    :param output: Format to encode as, or None for the input's (JPEG if unknown)
+    :return: (encoded image bytes, image format name)
+    """
+    from filters import apply_filter
+
+    with stage("filter"):
+        filtered_img = apply_filter(img, filter_type, seed=seed, stamp_text=stamp_text)
+    with stage("encode"):
+        img_io = io.BytesIO()
+        image_format = output or filtered_img.format or "JPEG"
+        filtered_img.save(img_io, format=image_format)
+    return img_io.getvalue(), image_format
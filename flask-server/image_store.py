@@ -0,0 +1,105 @@
+import os
+import time
+import uuid
+import threading
+from collections import OrderedDict
+
+############################
+# Session Image Store
+############################
+class ImageStore:
+    """
+    Keeps decoded, orientation-corrected uploads in memory so clients can
+    upload a photo once and then request filters by image_id.
+
+    Entries expire ttl seconds after their last use. When the decoded pixels
+    would exceed max_bytes, the least recently used entries are evicted.
+    """
+
+    def __init__(self, max_bytes=512 * 1024 * 1024, ttl=600):
+        """
+        :param max_bytes: Budget for decoded pixel data across all entries
+        :param ttl: Seconds an entry lives after it was last used
+        """
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.total_bytes = 0
+        self._entries = OrderedDict()  # image_id -> (img, nbytes, expires_at)
+        self._lock = threading.Lock()
+
+    def put(self, img):
+        """
+        Stores a decoded image.
+        :param img: PIL Image, already orientation-corrected
+        :return: image_id string
+        :raises ValueError: if the image alone is larger than max_bytes
+        """
+        img.load()
+        nbytes = image_nbytes(img)
+        if nbytes > self.max_bytes:
+            raise ValueError("Image is too large to keep in the image store")
+        image_id = uuid.uuid4().hex
+        with self._lock:
+            self._evict_expired()
+            while self.total_bytes + nbytes > self.max_bytes:
+                self._pop_oldest()
+            self._entries[image_id] = (img, nbytes, time.monotonic() + self.ttl)
+            self.total_bytes += nbytes
+        return image_id
+
+    def get(self, image_id):
+        """
+        Looks up an image and refreshes its TTL.
+        :param image_id: Value returned by put
+        :return: A copy of the PIL Image (filters may draw on it), or None
+                 if the id is unknown or expired
+        """
+        with self._lock:
+            self._evict_expired()
+            entry = self._entries.get(image_id)
+            if entry is None:
+                return None
+            img, nbytes, _ = entry
+            self._entries[image_id] = (img, nbytes, time.monotonic() + self.ttl)
+            self._entries.move_to_end(image_id)
+        return img.copy()
+
+    def delete(self, image_id):
+        """
+        Drops an image.
+        :return: True if it was stored
+        """
+        with self._lock:
+            entry = self._entries.pop(image_id, None)
+            if entry is None:
+                return False
+            self.total_bytes -= entry[1]
+            return True
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _pop_oldest(self):
+        _, (_, nbytes, _) = self._entries.popitem(last=False)
+        self.total_bytes -= nbytes
+
+    def _evict_expired(self):
+        # Entries are in last-used order and share one TTL, so expired ones
+        # are always at the front
+        now = time.monotonic()
+        while self._entries:
+            _, _, expires_at = next(iter(self._entries.values()))
+            if expires_at > now:
+                break
+            self._pop_oldest()
+
+def image_nbytes(img):
+    """
+    Approximate in-memory size of a decoded PIL Image.
+    """
+    return img.width * img.height * len(img.getbands())
+
+image_store = ImageStore(
+    max_bytes=int(os.environ.get("IMAGE_STORE_MAX_BYTES", 512 * 1024 * 1024)),
+    ttl=float(os.environ.get("IMAGE_STORE_TTL", 600)),
+)
@@ -0,0 +1,152 @@
+"""
+Load generator for the ASGI front end (asgi.py).
+
+Sends --requests uploads from --concurrency clients at once and reports the
+status codes, latency percentiles, throughput and the Retry-After values of
+rejected requests. By default the app is driven in-process (no server or
+extra packages needed). Use --url to load a running server instead, e.g.
+one started with `uvicorn asgi:app`.
+
+    python load_asgi.py [--requests 64] [--concurrency 16] [--filter digicam]
+                        [--size 1280x960] [--workers 2] [--queue 4]
+                        [--deadline 30] [--url http://127.0.0.1:8000]
+
+--workers, --queue and --deadline set ASGI_WORKERS, ASGI_QUEUE and
+ASGI_DEADLINE for the in-process app.
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import tempfile
+import time
+from urllib.parse import urlsplit
+
+from bench_lambda import synthetic_jpeg
+
+async def call_in_process(app, path, query, body):
+    """
+    :return: (status, headers dict)
+    """
+    scope = {'type': 'http', 'method': 'POST', 'path': path, 'query_string': query.encode('ascii'),
+             'headers': [(b'content-type', b'image/jpeg'),
+                         (b'content-length', str(len(body)).encode('ascii'))]}
+    messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+    response = {}
+
+    async def receive():
+        if messages:
+            return messages.pop()
+        await asyncio.Event().wait()  # stay connected until cancelled
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            response['status'] = message['status']
+            response['headers'] = {key.decode('latin-1'): value.decode('latin-1')
+                                   for key, value in message['headers']}
+
+    await app(scope, receive, send)
+    return response['status'], response['headers']
+
+async def call_http(url, path, query, body):
+    """
+    Minimal HTTP/1.1 client: one request per connection.
+    :return: (status, headers dict)
+    """
+    parts = urlsplit(url)
+    reader, writer = await asyncio.open_connection(parts.hostname, parts.port or 80)
+    try:
+        writer.write((f'POST {path}?{query} HTTP/1.1\r\nHost: {parts.netloc}\r\n'
+                      f'Content-Type: image/jpeg\r\nContent-Length: {len(body)}\r\n'
+                      'Connection: close\r\n\r\n').encode('ascii') + body)
+        await writer.drain()
+        status = int((await reader.readline()).split()[1])
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode('latin-1').strip()
+            if not line:
+                break
+            key, _, value = line.partition(':')
+            headers[key.strip().lower()] = value.strip()
+        await reader.read()
+        return status, headers
+    finally:
+        writer.close()
+
+async def run_load(call, body, query, requests, concurrency):
+    results = []
+    pending = iter(range(requests))
+
+    async def client():
+        for _ in pending:
+            start = time.perf_counter()
+            try:
+                status, headers = await call('/apply-filter', query, body)
+            except OSError as e:
+                status, headers = f'error: {e}', {}
+            results.append((status, time.perf_counter() - start, headers.get('retry-after')))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return results, time.perf_counter() - start
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=64)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--filter", default="digicam")
+    parser.add_argument("--size", default="1280x960")
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--queue", type=int)
+    parser.add_argument("--deadline", type=float)
+    parser.add_argument("--url")
+    args = parser.parse_args()
+
+    width, height = (int(n) for n in args.size.lower().split("x"))
+    with tempfile.TemporaryDirectory() as tmp:
+        image_path = os.path.join(tmp, "input.jpg")
+        synthetic_jpeg(image_path, width, height)
+        with open(image_path, "rb") as f:
+            body = f.read()
+
+    if args.url:
+        async def call(path, query, body):
+            return await call_http(args.url, path, query, body)
+    else:
+        for option, name in ((args.workers, "ASGI_WORKERS"), (args.queue, "ASGI_QUEUE"),
+                             (args.deadline, "ASGI_DEADLINE")):
+            if option is not None:
+                os.environ[name] = str(option)
+        # Otherwise repeatable filters (sepia, invert, ...) would be answered
+        # from the result cache after the first request
+        os.environ.setdefault("RESULT_CACHE", "off")
+        import asgi
+
+        async def call(path, query, body):
+            return await call_in_process(asgi.app, path, query, body)
+
+    results, seconds = asyncio.run(run_load(call, body, f"filter={args.filter}",
+                                            args.requests, args.concurrency))
+    statuses = {}
+    for status, _, _ in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    ok = [latency for status, latency, _ in results if status == 200]
+    report = {"requests": args.requests, "concurrency": args.concurrency, "filter": args.filter,
+              "size": args.size, "seconds": round(seconds, 3), "statuses": statuses,
+              "ok_per_s": round(len(ok) / seconds, 2)}
+    if ok:
+        report["latency_ms"] = {"p50": round(statistics.median(ok) * 1000, 1),
+                                "p95": round(percentile(ok, 0.95) * 1000, 1),
+                                "max": round(max(ok) * 1000, 1)}
+    retry_after = sorted({int(value) for _, _, value in results if value})
+    if retry_after:
+        report["retry_after"] = retry_after
+    print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
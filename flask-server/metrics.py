@@ -0,0 +1,133 @@
+import math
+import threading
+
+############################
+# Metrics
+############################
+# Counters, gauges and histograms with labels, rendered in the Prometheus
+# text exposition format by render(). Enough of a client for /metrics
+# without adding a dependency. Every metric is registered in REGISTRY when
+# it is created; collectors add values read at scrape time (cache counters).
+
+REGISTRY = []
+COLLECTORS = []
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labels=()):
+        """
+        :param name: Metric name
+        :param help_text: One line for the HELP comment
+        :param labels: Names of the labels every sample carries
+        """
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError(f"{self.name} takes labels {self.labels}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def samples(self):
+        """
+        :return: List of (suffix, label dict, value)
+        """
+        with self._lock:
+            return [("", dict(zip(self.labels, key)), value) for key, value in self._values.items()]
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+class Histogram(Metric):
+    kind = "histogram"
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value)
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total) in self._values.items():
+                labels = dict(zip(self.labels, key))
+                for bound, count in zip(self.buckets, counts):
+                    samples.append(("_bucket", dict(labels, le=_format_value(bound)), count))
+                samples.append(("_sum", labels, total))
+                samples.append(("_count", labels, counts[-1]))
+        return samples
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_sample(name, labels, value):
+    if labels:
+        pairs = ",".join(f'{key}="{_escape(label)}"' for key, label in labels.items())
+        return f"{name}{{{pairs}}} {_format_value(value)}"
+    return f"{name} {_format_value(value)}"
+
+def render():
+    """
+    :return: Every registered metric and collector, in Prometheus text format
+    """
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f"# HELP {metric.name} {metric.help_text}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for suffix, labels, value in metric.samples():
+            lines.append(_format_sample(metric.name + suffix, labels, value))
+    for collector in COLLECTORS:
+        for name, kind, help_text, value in collector():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.append(_format_sample(name, {}, value))
+    return "\n".join(lines) + "\n"
+
+MEGAPIXEL_BUCKETS = ((1, "0-1"), (4, "1-4"), (12, "4-12"), (24, "12-24"), (math.inf, "24+"))
+
+def megapixel_bucket(width, height):
+    """
+    :return: Label for the megapixel range width * height falls in
+    """
+    megapixels = width * height / 1e6
+    for bound, label in MEGAPIXEL_BUCKETS:
+        if megapixels <= bound:
+            return label
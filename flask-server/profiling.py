@@ -0,0 +1,295 @@
+"""
+Per-stage memory profiling for the filters.
+
+Every stage runs three times on the same input. The first run warms the
+caches and is not measured. The second is timed and measures peak RSS. The
+third runs under tracemalloc and an opcode tracer that count full-frame
+allocations. A full-frame allocation is anything at
+least the size of one 8-bit plane of the frame (width * height bytes): NumPy
+arrays and bytes made from Python code, plus PIL images of the frame's size
+or larger. Images decoded by Image.open and memory used inside C calls only
+show up in the RSS figures. The report is JSON.
+
+    python profiling.py [--size 1280x960] [--image photo.jpg]
+                        [--stages presets,effects,codec | name,...] [--output report.json]
+
+The server's /apply-filter returns the same report for one request when it is
+sent with profile=1 and PROFILE_REQUESTS=1 is set on the server.
+"""
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import threading
+import tracemalloc
+from PIL import Image
+
+############################
+# Peak RSS
+############################
+def _read_status(field):
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def reset_peak_rss():
+    """
+    Resets the process's RSS high-water mark where Linux allows it.
+    :return: True if the next peak_rss() covers only what follows
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+def current_rss():
+    return _read_status("VmRSS")
+
+def peak_rss():
+    """
+    :return: Peak RSS in bytes (since reset_peak_rss, or since process start)
+    """
+    peak = _read_status("VmHWM")
+    if peak is None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak *= 1 if sys.platform == "darwin" else 1024
+    return peak
+
+############################
+# Full-frame Allocation Counting
+############################
+_profile_lock = threading.Lock()
+
+class FullFrameCounter:
+    """
+    Counts full-frame allocations made on the calling thread while active.
+
+    NumPy data and bytes objects are seen through tracemalloc: after every
+    Python opcode the tracemalloc peak is checked and reset, and an opcode
+    whose peak rose by at least frame_bytes counts as one allocation. PIL
+    images are seen through Image.Image._new, which every PIL operation
+    that returns a new image goes through.
+    """
+
+    def __init__(self, frame_bytes):
+        self.frame_bytes = frame_bytes
+        self.numpy = 0
+        self.pil = 0
+        self._thread = None
+        self._new = None
+        self._base = 0
+        # tracemalloc peak over the whole run; the counter resets the
+        # tracemalloc peak after every opcode
+        self.peak = 0
+
+    def __enter__(self):
+        self._thread = threading.get_ident()
+        self._new = Image.Image._new
+        counter = self
+        original_new = self._new
+
+        def counting_new(image, im):
+            new_image = original_new(image, im)
+            if (threading.get_ident() == counter._thread
+                    and new_image.width * new_image.height >= counter.frame_bytes):
+                counter.pil += 1
+            return new_image
+
+        Image.Image._new = counting_new
+        tracemalloc.reset_peak()
+        self._base = tracemalloc.get_traced_memory()[0]
+        sys.settrace(self._trace_call)
+        return self
+
+    def __exit__(self, *exc):
+        sys.settrace(None)
+        self._check()
+        Image.Image._new = self._new
+        return False
+
+    def _check(self):
+        current, peak = tracemalloc.get_traced_memory()
+        if peak - self._base >= self.frame_bytes:
+            self.numpy += 1
+        self.peak = max(self.peak, peak)
+        tracemalloc.reset_peak()
+        self._base = current
+
+    def _trace_call(self, frame, event, arg):
+        frame.f_trace_opcodes = True
+        return self._trace_opcode
+
+    def _trace_opcode(self, frame, event, arg):
+        self._check()
+        return self._trace_opcode
+
+def profile_stage(name, func, make_input, frame_pixels):
+    """
+    Profiles one stage.
+    :param name: Stage name for the report
+    :param func: func(input) -> result
+    :param make_input: Called (unmeasured) before each run to build func's input
+    :param frame_pixels: width * height of the frame, for the full-frame threshold
+    :return: (result of the first run, report dict)
+    """
+    with _profile_lock:
+        # Warm-up: lazily built caches (LUTs, vignette masks, glyphs) are not
+        # what a warm server pays per request
+        result = func(make_input())
+
+        stage_input = make_input()
+        resettable = reset_peak_rss()
+        rss_before = current_rss()
+        start = time.perf_counter()
+        func(stage_input)
+        seconds = time.perf_counter() - start
+        report = {"stage": name, "seconds": round(seconds, 4), "peak_rss_bytes": peak_rss(),
+                  "peak_rss_resettable": resettable}
+        if rss_before is not None and resettable:
+            report["rss_growth_bytes"] = report["peak_rss_bytes"] - rss_before
+
+        stage_input = make_input()
+        was_tracing = tracemalloc.is_tracing()
+        if not was_tracing:
+            tracemalloc.start()
+        try:
+            baseline = tracemalloc.get_traced_memory()[0]
+            with FullFrameCounter(frame_pixels) as counter:
+                func(stage_input)
+            report["tracemalloc_peak_bytes"] = counter.peak - baseline
+        finally:
+            if not was_tracing:
+                tracemalloc.stop()
+        report["full_frame_allocations"] = {"numpy": counter.numpy, "pil": counter.pil}
+    return result, report
+
+def profile_stages(stages, make_input, frame_pixels):
+    """
+    Profiles several stages on the same input; a failing stage is reported
+    with its error instead of stopping the run.
+    :param stages: dict of name -> func(input)
+    :return: List of report dicts
+    """
+    reports = []
+    for name, func in stages.items():
+        try:
+            reports.append(profile_stage(name, func, make_input, frame_pixels)[1])
+        except Exception as e:
+            reports.append({"stage": name, "error": str(e)})
+    return reports
+
+############################
+# Stages
+############################
+def effect_stages(seed=0):
+    """
+    :return: dict of effect function name -> func(img), default arguments,
+             random effects seeded
+    """
+    import filters as F
+    return {
+        "add_film_grain": lambda img: F.add_film_grain(img, rng=F.make_rng(seed)),
+        "add_light_leaks": lambda img: F.add_light_leaks(img, rng=F.make_rng(seed)),
+        "apply_vignette": F.apply_vignette,
+        "apply_sepia": F.apply_sepia,
+        "apply_cross_processing": F.apply_cross_processing,
+        "apply_lomo": F.apply_lomo,
+        "add_chromatic_aberration": F.add_chromatic_aberration,
+        "add_halation": F.add_halation,
+        "add_date_stamp_bottom_right": lambda img: F.add_date_stamp_bottom_right(img, text="2024-01-01 12:00"),
+        "add_polaroid_frame": F.add_polaroid_frame,
+        "add_vhs_glitch": lambda img: F.add_vhs_glitch(img, rng=F.make_rng(seed)),
+        "add_lens_flare": lambda img: F.add_lens_flare(img, rng=F.make_rng(seed)),
+        "apply_tilt_shift": F.apply_tilt_shift,
+        "add_green_tint": F.add_green_tint,
+        "apply_posterize": F.apply_posterize,
+    }
+
+def preset_stages(seed=0):
+    """
+    :return: dict of "preset:<name>" -> func(img) for every entry of FILTERS
+    """
+    from filters import FILTERS, apply_filter
+    return {f"preset:{name}": (lambda img, name=name: apply_filter(img, name, seed=seed,
+                                                                   stamp_text="2024-01-01 12:00"))
+            for name in FILTERS}
+
+def encode_jpeg(img):
+    img_io = io.BytesIO()
+    img.save(img_io, format="JPEG")
+    return img_io.getvalue()
+
+def report_header(img):
+    return {"width": img.width, "height": img.height, "frame_pixels": img.width * img.height,
+            "python": platform.python_version(), "platform": platform.platform()}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", default="1280x960")
+    parser.add_argument("--image", help="Profile this photo instead of a synthetic one")
+    parser.add_argument("--stages", default="presets,effects,codec")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    from image_io import open_image
+    if args.image:
+        with open(args.image, "rb") as f:
+            data = f.read()
+    else:
+        from bench_lambda import synthetic_jpeg
+        import tempfile
+        width, height = (int(n) for n in args.size.lower().split("x"))
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "input.jpg")
+            synthetic_jpeg(path, width, height)
+            with open(path, "rb") as f:
+                data = f.read()
+
+    width, height = Image.open(io.BytesIO(data)).size  # header only
+    frame_pixels = width * height
+    img, decode_report = profile_stage("decode", open_image, lambda: io.BytesIO(data), frame_pixels)
+
+    stages = {}
+    groups = args.stages.split(",")
+    if "presets" in groups:
+        stages.update(preset_stages(args.seed))
+    if "effects" in groups:
+        stages.update(effect_stages(args.seed))
+    named = set(groups) - {"presets", "effects", "codec"}
+    if named:
+        everything = {**preset_stages(args.seed), **effect_stages(args.seed)}
+        unknown = named - set(everything)
+        if unknown:
+            parser.error(f"unknown stages: {', '.join(sorted(unknown))}")
+        stages.update({name: everything[name] for name in named})
+
+    report = report_header(img)
+    report["stages"] = []
+    if "codec" in groups:
+        report["stages"].append(decode_report)
+    report["stages"] += profile_stages(stages, img.copy, frame_pixels)
+    if "codec" in groups:
+        rgb = img.convert("RGB")
+        report["stages"].append(profile_stage("encode", encode_jpeg, lambda: rgb, frame_pixels)[1])
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+import os
+import json
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+############################
+# Result Cache
+############################
+# Encoded filter outputs keyed by a hash of everything that decides them:
+# the input image bytes, the filter name and its parameters (including the
+# seed for random filters). Both backends are bounded by the total size of
+# the stored results and evict the least recently used ones first.
+
+def result_cache_key(source, filter_type, **params):
+    """
+    :param source: Input image bytes (or another stable identity as bytes)
+    :param filter_type: Name of the filter
+    :param params: Anything else that changes the output (seed, size, ...)
+    :return: Hex digest
+    """
+    digest = hashlib.sha256(source)
+    digest.update(json.dumps([filter_type, params], sort_keys=True).encode('utf-8'))
+    return digest.hexdigest()
+
+class MemoryResultCache:
+    """
+    In-process cache; survives between requests (and warm Lambda
+    invocations) but not restarts.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (data, image format)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        :return: (data, image format) or None
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, data, image_format):
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.total_bytes -= len(old[0])
+            while self._entries and self.total_bytes + len(data) > self.max_bytes:
+                _, (evicted, _) = self._entries.popitem(last=False)
+                self.total_bytes -= len(evicted)
+            self._entries[key] = (data, image_format)
+            self.total_bytes += len(data)
+
+class DiskResultCache:
+    """
+    Cache in a local directory, one file per result named <key>.<format>.
+    Recency is tracked in memory and seeded from file mtimes at startup, so
+    a restarted server keeps its results.
+    """
+
+    def __init__(self, directory, max_bytes=512 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (image format, size)
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        found = []
+        for name in os.listdir(directory):
+            key, _, image_format = name.partition('.')
+            if not image_format or name.endswith('.tmp'):
+                continue
+            stat = os.stat(os.path.join(directory, name))
+            found.append((stat.st_mtime, key, image_format, stat.st_size))
+        for _, key, image_format, size in sorted(found):
+            self._entries[key] = (image_format, size)
+            self.total_bytes += size
+        with self._lock:
+            self._evict(0)
+
+    def get(self, key):
+        """
+        :return: (data, image format) or None
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+        path = self._path(key, entry[0])
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+        except OSError:
+            # Removed behind our back
+            with self._lock:
+                if self._entries.pop(key, None) is not None:
+                    self.total_bytes -= entry[1]
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return data, entry[0]
+
+    def put(self, key, data, image_format):
+        if len(data) > self.max_bytes:
+            return
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, self._path(key, image_format))
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.total_bytes -= old[1]
+            self._evict(len(data))
+            self._entries[key] = (image_format, len(data))
+            self.total_bytes += len(data)
+
+    def _evict(self, incoming):
+        while self._entries and self.total_bytes + incoming > self.max_bytes:
+            key, (image_format, size) = self._entries.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.remove(self._path(key, image_format))
+            except OSError:
+                pass
+
+    def _path(self, key, image_format):
+        return os.path.join(self.directory, f'{key}.{image_format.lower()}')
+
+def make_result_cache(backend=None, max_bytes=None, directory=None):
+    """
+    Builds the cache configured by the arguments or, where they are None,
+    the RESULT_CACHE ("memory", "disk" or "off"), RESULT_CACHE_MAX_BYTES and
+    RESULT_CACHE_DIR environment variables.
+    :return: MemoryResultCache, DiskResultCache or None when turned off
+    """
+    backend = backend or os.environ.get('RESULT_CACHE', 'memory')
+    if max_bytes is None and os.environ.get('RESULT_CACHE_MAX_BYTES'):
+        max_bytes = int(os.environ['RESULT_CACHE_MAX_BYTES'])
+    if backend == 'off':
+        return None
+    if backend == 'memory':
+        return MemoryResultCache(max_bytes or 64 * 1024 * 1024)
+    if backend == 'disk':
+        directory = directory or os.environ.get(
+            'RESULT_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'filter-results'))
+        return DiskResultCache(directory, max_bytes or 512 * 1024 * 1024)
+    raise ValueError(f'Unknown result cache backend: {backend}')
@@ -1,477 +1,419 @@
-from flask import Flask, request, jsonify, send_file
-from PIL import Image, ImageOps, ImageEnhance, ImageDraw, ImageFilter, ImageFont
+from flask import Flask, request, jsonify, send_file, g
+from PIL import Image
 import io
 import os
-import numpy as np
-import random
+import time
+import json
+import base64
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from filters import FILTERS, apply_filter
+from image_io import (cached_result, filter_and_encode, open_image, parse_filter_request,
+                      parse_max_dimension, store_result)
+from image_store import image_store
+from engine import make_filter_engine
+from result_cache import make_result_cache
+from profiling import encode_jpeg, profile_stage, report_header
+from timing import StageTimer, stage, write_trace
+import metrics
+from metrics import Counter, Gauge, Histogram, megapixel_bucket
 
 app = Flask(__name__)
 
-############################
-# 1. Film Grain
-############################
-def add_film_grain(image, intensity=50, offset=25):
-    """
-    Adds film-like grain by injecting random noise.
-    :param image: PIL Image
-    :param intensity: Max noise value (0-255). Higher => more grain
-    :param offset: Offset to shift the noise distribution
-    :return: PIL Image with film grain
-    """
-    np_img = np.array(image.convert('RGB'), dtype=np.int16)
-    noise = np.random.randint(0, intensity, (np_img.shape[0], np_img.shape[1], 1), dtype='int16')
-    noise = np.repeat(noise, 3, axis=2)  # replicate into R/G/B
-    np_img = np_img + noise - offset
-    np_img = np.clip(np_img, 0, 255).astype('uint8')
-    return Image.fromarray(np_img)
+# Encoded results of repeatable requests; see result_cache.make_result_cache
+result_cache = make_result_cache()
 
-############################
-# 2. Light Leaks
-############################
-def add_light_leaks(image, leak_count=5, alpha=0.25):
-    """
-    Adds random elliptical color overlays ("light leaks").
-    :param image: PIL Image
-    :param leak_count: How many leaks
-    :param alpha: Blend factor
-    :return: PIL Image
-    """
-    overlay = Image.new('RGB', image.size, (0, 0, 0))
-    draw = ImageDraw.Draw(overlay)
-    width, height = image.size
-    
-    possible_colors = [
-        (255, 200, 100),
-        (255, 150, 50),
-        (255, 50, 50),
-        (255, 220, 180),
-        (255, 100, 200),
-    ]
-    
-    for _ in range(leak_count):
-        x = random.randint(0, width)
-        y = random.randint(0, height)
-        radius = random.randint(50, 200)
-        color = random.choice(possible_colors)
-        draw.ellipse(
-            [(x - radius, y - radius), (x + radius, y + radius)],
-            fill=color
-        )
-        
-    return Image.blend(image, overlay, alpha=alpha)
+# Worker processes for filter_image; None runs filters in the request thread
+filter_engine = make_filter_engine()
 
 ############################
-# 3. Vignette
+# Request timing
 ############################
-def apply_vignette(image, radius_factor=1.6, strength=0.7):
-    """
-    Darken edges to create a vignette.
-    :param image: PIL Image
-    :param radius_factor: Determines ellipse size
-    :param strength: How strong (dark) the vignette is
-    :return: PIL Image
-    """
-    width, height = image.size
-    vignette_mask = Image.new('L', (width, height), 0)
-    draw = ImageDraw.Draw(vignette_mask)
-    
-    max_radius = int(min(width, height) // radius_factor)
-    
-    draw.ellipse(
-        [(width//2 - max_radius, height//2 - max_radius),
-         (width//2 + max_radius, height//2 + max_radius)],
-        fill=255
-    )
-    
-    # Blur for smooth edges
-    vignette_mask = vignette_mask.filter(ImageFilter.GaussianBlur(radius=width // 4))
-    
-    # Invert and scale by strength
-    inverted_mask = ImageOps.invert(vignette_mask)
-    final_mask = inverted_mask.point(lambda x: x * strength)
-    
-    black_bg = Image.new('RGB', (width, height), (0, 0, 0))
-    return Image.composite(black_bg, image, final_mask).convert('RGB')
+@app.before_request
+def start_request_timer():
+    g.timer = StageTimer().start()
+    with stage("upload"):
+        request.form  # reads and parses the whole body, files included
+
+@app.after_request
+def add_server_timing(response):
+    if 'timer' in g:
+        response.headers['Server-Timing'] = g.timer.server_timing()
+        write_trace(g.timer, method=request.method, path=request.path,
+                    status=response.status_code, filter=request.form.get('filter'))
+    return response
+
+@app.teardown_request
+def stop_request_timer(exc):
+    if 'timer' in g:
+        g.timer.stop()
 
 ############################
-# 4. Sepia
+# Metrics
 ############################
-def apply_sepia(img):
-    """
-    Applies a sepia effect.
+# Per process: behind several server processes, sum them in Prometheus
+REQUESTS = Counter('http_requests_total', 'Requests by route, method and status',
+                   ('route', 'method', 'status'))
+IN_FLIGHT = Gauge('http_requests_in_flight', 'Requests being handled', ('route',))
+BYTES_IN = Counter('http_request_bytes_total', 'Request body bytes received', ('route',))
+BYTES_OUT = Counter('http_response_bytes_total', 'Response body bytes sent', ('route',))
+FILTER_REQUESTS = Counter('filter_requests_total', '/apply-filter requests by filter and status',
+                          ('filter', 'status'))
+FILTER_ERRORS = Counter('filter_errors_total', '/apply-filter requests that failed, by filter',
+                        ('filter',))
+REQUEST_LATENCY = Histogram('filter_request_duration_seconds',
+                            'Time to answer /apply-filter, by filter and input size',
+                            ('filter', 'megapixels'))
+FILTER_LATENCY = Histogram('filter_duration_seconds',
+                           'Time spent filtering and encoding one image, by filter and size',
+                           ('filter', 'megapixels'))
+
+def filter_label(filter_type):
+    """
+    Filter name for metric labels; anything a client made up is folded into
+    "unknown" so it cannot blow up the label set, and every pipeline spec
+    into "pipeline".
+    """
+    if filter_type is None:
+        return 'none'
+    if not isinstance(filter_type, str):
+        return 'pipeline'
+    return filter_type if filter_type in FILTERS else 'unknown'
+
+def _route():
+    return request.url_rule.rule if request.url_rule else 'unmatched'
+
+@app.before_request
+def start_request_metrics():
+    g.request_started = time.perf_counter()
+    IN_FLIGHT.inc(route=_route())
+    BYTES_IN.inc(request.content_length or 0, route=_route())
+
+@app.after_request
+def record_request_metrics(response):
+    route = _route()
+    REQUESTS.inc(route=route, method=request.method, status=response.status_code)
+    BYTES_OUT.inc(response.content_length or 0, route=route)
+    if route == '/apply-filter':
+        label = 'pipeline' if request.form.get('pipeline') else filter_label(request.form.get('filter'))
+        FILTER_REQUESTS.inc(filter=label, status=response.status_code)
+        if response.status_code >= 400:
+            FILTER_ERRORS.inc(filter=label)
+        megapixels = g.get('megapixels') or ('cached' if response.headers.get('X-Cache') == 'HIT' else 'none')
+        REQUEST_LATENCY.observe(time.perf_counter() - g.request_started,
+                                filter=label, megapixels=megapixels)
+    return response
+
+@app.teardown_request
+def finish_request_metrics(exc):
+    if 'request_started' in g:
+        IN_FLIGHT.dec(route=_route())
+
+def _store_metrics():
+    values = [('image_store_entries', 'gauge', 'Decoded photos held for image_id requests',
+               len(image_store))]
+    if result_cache is not None:
+        values += [
+            ('result_cache_hits_total', 'counter', 'Result cache hits', result_cache.hits),
+            ('result_cache_misses_total', 'counter', 'Result cache misses', result_cache.misses),
+            ('result_cache_bytes', 'gauge', 'Encoded results held by the cache', result_cache.total_bytes),
+        ]
+    return values
+
+metrics.COLLECTORS.append(_store_metrics)
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    return app.response_class(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+def filter_image(img, filter_type, seed=None, stamp_text=None):
+    """
+    Applies a filter to a decoded image and encodes the result.
     :param img: PIL Image
-    :return: PIL Image
+    :param filter_type: Name of the filter
+    :param seed: Optional seed for the random parts of the filter
+    :param stamp_text: Optional date stamp text
+    :return: (BytesIO positioned at 0, image format name)
     """
-    sepia_filter = ImageEnhance.Color(img)
-    img = sepia_filter.enhance(0.7)  # lower saturation first
-    
-    np_img = np.array(img)
-    sepia_overlay = np.dot(
-        np_img[..., :3],
-        [[0.272, 0.534, 0.131],
-         [0.349, 0.686, 0.168],
-         [0.393, 0.769, 0.189]]
-    )
-    sepia_overlay = np.clip(sepia_overlay, 0, 255).astype('uint8')
-    return Image.fromarray(sepia_overlay)
+    started = time.perf_counter()
+    try:
+        return _filter_image(img, filter_type, seed, stamp_text)
+    finally:
+        FILTER_LATENCY.observe(time.perf_counter() - started, filter=filter_label(filter_type),
+                               megapixels=megapixel_bucket(*img.size))
+
+def _filter_image(img, filter_type, seed, stamp_text):
+    if filter_engine is not None:
+        with stage("worker"):
+            data, original_format = filter_engine.run(img, filter_type, seed, stamp_text)
+        return io.BytesIO(data), original_format
+
+    data, original_format = filter_and_encode(img, filter_type, seed, stamp_text)
+    return io.BytesIO(data), original_format
+
+def request_image(max_dimension=None):
+    """
+    Returns the image a request refers to: the uploaded 'image' file, or the
+    stored frame named by the 'image_id' form field.
+    :param max_dimension: Optional longest side to decode/resize down to
+    :return: PIL Image the caller may modify
+    :raises LookupError: if image_id is unknown or has expired
+    """
+    if 'image_id' in request.form:
+        img = image_store.get(request.form['image_id'])
+        if img is None:
+            raise LookupError('Unknown or expired image_id')
+        if max_dimension and max(img.size) > max_dimension:
+            img.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+    else:
+        # Always reload the original image for each request
+        img = open_image(request.files['image'].stream, max_dimension)
+    g.megapixels = megapixel_bucket(*img.size)
+    return img
 
-############################
-# 5. Cross Processing
-############################
-def apply_cross_processing(img):
+def request_source():
     """
-    Mimic cross-processing effect via color shifts.
-    :param img: PIL Image
-    :return: PIL Image
+    :return: Bytes identifying the image a request refers to, for the result
+             cache key: the upload itself, or its image_id
     """
-    np_img = np.array(img.convert('RGB'), dtype=np.float32)
-    np_img /= 255.0
-    
-    # Tweak channels for a "cross-processed" look
-    np_img[..., 1] = np.power(np_img[..., 1], 0.9)   # green
-    np_img[..., 0] = np.clip(np_img[..., 0] * 1.1, 0, 1)  # red
-    np_img[..., 2] = np.power(np_img[..., 2], 0.8)   # blue
-    
-    np_img = np.clip(np_img * 255, 0, 255).astype('uint8')
-    return Image.fromarray(np_img)
+    if 'image_id' in request.form:
+        return b'image_id:' + request.form['image_id'].encode('utf-8')
+    source = request.files['image'].read()
+    request.files['image'].stream.seek(0)
+    return source
 
-############################
-# 6. Lomo Effect
-############################
-def apply_lomo(image):
-    """
-    Lomo-style effect: high contrast, saturated colors, heavy vignette.
-    :param image: PIL Image
-    :return: PIL Image
-    """
-    # Boost saturation
-    enhancer = ImageEnhance.Color(image)
-    lomo_img = enhancer.enhance(1.1)
-    
-    # Slight contrast bump
-    enhancer = ImageEnhance.Contrast(lomo_img)
-    lomo_img = enhancer.enhance(1.05)
-    
-    # Subtle color shift (cheap lens effect)
-    np_img = np.array(lomo_img.convert('RGB'), dtype=np.float32)
-    np_img[..., 1] = np.clip(np_img[..., 1] * 1.05, 0, 255)  # extra green
-    lomo_img = Image.fromarray(np_img.astype('uint8'))
-    
-    # Heavy vignette
-    lomo_img = apply_vignette(lomo_img, radius_factor=1.3, strength=1.0)
-    return lomo_img
+@app.route('/apply-filter', methods=['POST'])
+def upload_and_filter():
+    if 'image' not in request.files and 'image_id' not in request.form:
+        return jsonify({'error': 'No image file or image_id found in the request'}), 400
+    try:
+        # A pipeline spec takes the place of a preset name
+        filter_request = parse_filter_request(request.form.get('filter'), request.form.get('pipeline'),
+                                              request.form.get('max_dimension'), request.form.get('seed'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    filter_type, max_dimension, seed, stamp_text = filter_request
+    if request.form.get('profile'):
+        return profile_request(filter_type, max_dimension, seed, stamp_text)
+    cache_key, cached = cached_result(result_cache, request_source, filter_request)
+    if cached is not None:
+        data, original_format = cached
+        response = send_file(io.BytesIO(data), mimetype=f'image/{original_format.lower()}')
+        response.headers['X-Cache'] = 'HIT'
+        return response
 
-############################
-# 7. Chromatic Aberration
-############################
-def add_chromatic_aberration(img, shift=5):
-    """
-    Slightly misalign color channels.
-    :param img: PIL Image
-    :param shift: Pixel shift for R/B
-    :return: PIL Image
-    """
-    r, g, b = img.convert('RGB').split()
-    r = r.transform(r.size, Image.AFFINE, (1, 0, -shift, 0, 1, 0))
-    b = b.transform(b.size, Image.AFFINE, (1, 0, shift, 0, 1, 0))
-    return Image.merge("RGB", (r, g, b))
+    try:
+        with stage("decode"):
+            img = request_image(max_dimension)
+    except LookupError as e:
+        return jsonify({'error': str(e)}), 404
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    try:
+        img_io, original_format = filter_image(img, filter_type, seed, stamp_text)
+        store_result(result_cache, cache_key, img_io.getvalue(), original_format)
 
-############################
-# 8. Halation (Bloom / Glow)
-############################
-def add_halation(img, blur_radius=15, intensity=0.4):
-    """
-    Adds a soft glow around bright areas.
-    :param img: PIL Image
-    :param blur_radius: How big the glow is
-    :param intensity: Blend strength
-    :return: PIL Image
-    """
-    base = img.convert("RGB")
-    gray = base.convert("L")
-    bright_mask = gray.point(lambda p: 255 if p > 180 else 0, mode='1')
-    bright_mask_img = bright_mask.convert("RGB")
-    glow = bright_mask_img.filter(ImageFilter.GaussianBlur(blur_radius))
-    return Image.blend(base, glow, intensity)
+        # Return the processed image
+        response = send_file(img_io, mimetype=f'image/{original_format.lower()}')
+        response.headers['X-Cache'] = 'MISS' if cache_key is not None else 'BYPASS'
+        return response
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
 
 ############################
-# 9. Dust & Scratches Overlay
+# Profiling
 ############################
-def add_dust_and_scratches(img, dust_image_path="dust_texture.png", alpha=0.3):
-    """
-    Overlays a dust/scratches texture.
-    :param img: PIL Image
-    :param dust_image_path: Path to dust texture
-    :param alpha: Blend factor
-    :return: PIL Image
-    """
-    base = img.convert("RGBA")
-    dust = Image.open(dust_image_path).convert("RGBA")
-    dust = dust.resize(img.size)
-    dust.putalpha(int(alpha * 255))
-    return Image.alpha_composite(base, dust).convert("RGB")
+# Profiling reruns every stage and traces each Python opcode, so it is only
+# available when the server is started with PROFILE_REQUESTS=1
+PROFILE_REQUESTS = os.environ.get("PROFILE_REQUESTS") == "1"
 
-############################
-# 10. Date/Time Stamp
-############################
-def add_date_stamp_bottom_right(img, text=None, padding=50, font_size=52, color=(255,222,33)):
+def profile_request(filter_type, max_dimension, seed, stamp_text):
     """
-    Adds a date/time stamp to the bottom-right corner with a bigger font.
+    Answers an /apply-filter request sent with profile=1: instead of the
+    image, returns the profiling.py JSON report for its decode, filter and
+    encode stages. Filters run in the request thread even when the process
+    pool is on.
     """
-    if text is None:
-        from datetime import datetime
-        text = datetime.now().strftime('%Y-%m-%d %H:%M')
-    
-    draw = ImageDraw.Draw(img)
-    
-    # Specify a known valid TTF with a large font size
+    if not PROFILE_REQUESTS:
+        return jsonify({'error': 'Profiling is disabled on this server'}), 403
+    data = None if 'image_id' in request.form else request.files['image'].read()
+
+    def decode(_):
+        if data is None:
+            return request_image(max_dimension)
+        return open_image(io.BytesIO(data), max_dimension)
+
     try:
-        font = ImageFont.truetype("/Users/princekumar/Documents/digitalCameraApp/flask-server/font.ttf", font_size)
-    except OSError:
-        print("TTF not found, using default font. Text may be small.")
-        font = ImageFont.load_default()
-    
-    # In modern Pillow versions, use textbbox or font.getsize:
-    text_bbox = draw.textbbox((0, 0), text, font=font)
-    text_width = text_bbox[2] - text_bbox[0]
-    text_height = text_bbox[3] - text_bbox[1]
-    
-    img_width, img_height = img.size
-    x = img_width - text_width - padding
-    y = img_height - text_height - padding
-    
-    draw.text((x, y), text, fill=color, font=font)
-    return img
+        img = decode(None)
+    except LookupError as e:
+        return jsonify({'error': str(e)}), 404
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    frame_pixels = img.width * img.height
+    report = report_header(img)
+    report['filter'] = filter_type
+    try:
+        stages = [profile_stage('decode', decode, lambda: None, frame_pixels)[1]]
+        filtered_img, filter_report = profile_stage(
+            'filter', lambda frame: apply_filter(frame, filter_type, seed=seed, stamp_text=stamp_text),
+            img.copy, frame_pixels)
+        stages.append(filter_report)
+        stages.append(profile_stage('encode', encode_jpeg, lambda: filtered_img, frame_pixels)[1])
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    report['stages'] = stages
+    return jsonify(report)
 
 ############################
-# 11. Polaroid / Instant Camera Frame
+# Session images
 ############################
-def add_polaroid_frame(img, frame_width=50, bottom_extra=30, background_color=(255, 255, 255)):
+@app.route('/images', methods=['POST'])
+def upload_image():
     """
-    Adds a Polaroid-style frame: thicker at the bottom.
-    :param img: PIL Image
-    :param frame_width: Border thickness for sides/top
-    :param bottom_extra: Extra thickness at bottom
-    :param background_color: Frame color (white)
-    :return: PIL Image
+    Decodes and stores an upload so later requests can send 'image_id'
+    instead of the image bytes. Accepts the same optional 'max_dimension'
+    as /apply-filter.
     """
-    width, height = img.size
-    new_width = width + frame_width * 2
-    new_height = height + frame_width + bottom_extra
-    frame = Image.new('RGB', (new_width, new_height), background_color)
-    frame.paste(img, (frame_width, frame_width))
-    return frame
+    if 'image' not in request.files:
+        return jsonify({'error': 'No image file found in the request'}), 400
+    try:
+        max_dimension = parse_max_dimension(request.form.get('max_dimension'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    try:
+        img = open_image(request.files['image'].stream, max_dimension)
+        image_id = image_store.put(img)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 413
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    return jsonify({'image_id': image_id, 'width': img.width, 'height': img.height,
+                    'expires_in': image_store.ttl}), 201
 
-############################
-# 12. Glitch / VHS Overlay
-############################
-def add_vhs_glitch(img, line_height=2, glitch_strength=10, alpha=0.3):
-    """
-    Adds horizontal glitch lines for a VHS look.
-    :param img: PIL Image
-    :param line_height: Height of glitch lines
-    :param glitch_strength: Horizontal shift
-    :param alpha: Blend factor
-    :return: PIL Image
-    """
-    base = img.convert("RGBA")
-    overlay = Image.new("RGBA", base.size, (0, 0, 0, 0))
-    draw = ImageDraw.Draw(overlay)
-    width, height = base.size
-    
-    for y in range(0, height, line_height * 2):
-        shift = random.randint(-glitch_strength, glitch_strength)
-        draw.rectangle(
-            [(0 + shift, y), (width + shift, y + line_height)],
-            fill=(255, 0, 0, 80)
-        )
-
-    # Composite the overlay
-    glitched = Image.alpha_composite(base, overlay).convert("RGB")
-    # Subtly fade everything using point
-    return glitched.point(lambda px: px * alpha + (1 - alpha) * px)
+@app.route('/images/<image_id>', methods=['DELETE'])
+def delete_image(image_id):
+    if not image_store.delete(image_id):
+        return jsonify({'error': 'Unknown or expired image_id'}), 404
+    return '', 204
 
 ############################
-# 13. Lens Flare
+# Filter gallery
 ############################
-def add_lens_flare(img, flare_center=None, radius=80, color=(255, 255, 200), intensity=0.4):
-    """
-    Adds a lens flare circle.
-    :param img: PIL Image
-    :param flare_center: (x, y) if None, random
-    :param radius: Radius of flare
-    :param color: Flare color
-    :param intensity: Blend factor
-    :return: PIL Image
-    """
-    width, height = img.size
-    if flare_center is None:
-        flare_center = (random.randint(0, width), random.randint(0, height))
-    
-    overlay = Image.new('RGBA', img.size, (0, 0, 0, 0))
-    draw = ImageDraw.Draw(overlay)
-    draw.ellipse(
-        [(flare_center[0] - radius, flare_center[1] - radius),
-         (flare_center[0] + radius, flare_center[1] + radius)],
-        fill=color + (180,)
-    )
-    return Image.blend(img.convert('RGBA'), overlay, intensity).convert('RGB')
+GALLERY_DEFAULT_SIZE = 256
+GALLERY_MAX_SIZE = 1024
 
-############################
-# 14. Tilt-Shift / Depth of Field
-############################
-def apply_tilt_shift(image, blur_strength=15, focus_center=None, focus_height=100):
+@app.route('/filter-gallery', methods=['POST'])
+def filter_gallery():
     """
-    Simulates tilt-shift by blurring top/bottom, leaving a central band in focus.
-    :param image: PIL Image
-    :param blur_strength: GaussianBlur radius
-    :param focus_center: Vertical center of focus band
-    :param focus_height: Height of the band in focus
-    :return: PIL Image
-    """
-    width, height = image.size
-    if focus_center is None:
-        focus_center = height // 2
-    
-    blurred = image.filter(ImageFilter.GaussianBlur(blur_strength))
-    mask = Image.new('L', (width, height), 0)
-    draw = ImageDraw.Draw(mask)
-    
-    top_focus = focus_center - focus_height // 2
-    bottom_focus = focus_center + focus_height // 2
-    draw.rectangle([(0, top_focus), (width, bottom_focus)], fill=255)
-    
-    # Feather edges
-    mask = mask.filter(ImageFilter.GaussianBlur(blur_strength // 2))
-    
-    return Image.composite(image, blurred, mask)
-
-def add_green_tint(image, factor=1.05):
-    """
-    Adds a mild green tint by scaling the green channel.
-    
-    :param image: PIL Image
-    :param factor: How much to multiply the green channel (1.0 = no change)
-    :return: PIL Image with a greenish tint
-    """
-    # Convert to RGB just in case (and to avoid issues with RGBA or L modes)
-    np_img = np.array(image.convert('RGB'), dtype=np.float32)
-    
-    # Multiply the green channel by 'factor'
-    # e.g. factor=1.05 => 5% more green
-    np_img[..., 1] = np.clip(np_img[..., 1] * factor, 0, 255)
-    
-    # Convert back to uint8 and then back to PIL Image
-    np_img = np_img.astype('uint8')
-    return Image.fromarray(np_img)
+    Renders thumbnails of one image through several filters.
 
-############################
-# 15. Posterize (Example of Cross Hatch / Sketch / Posterize)
-############################
-def apply_posterize(image, bits=3):
-    """
-    Posterize the image to reduce color levels.
-    :param image: PIL Image
-    :param bits: Number of bits (1-8). Lower => fewer colors.
-    :return: PIL Image
+    Send one 'image' (or an 'image_id'), optional repeated 'filter' fields
+    (default: every entry of FILTERS) and an optional 'thumbnail_size'
+    (longest side in pixels).
+    The image is decoded, orientation-corrected and downscaled once; the
+    response is JSON with a base64 JPEG per filter and per-filter errors.
     """
-    return ImageOps.posterize(image, bits)
+    if 'image' not in request.files and 'image_id' not in request.form:
+        return jsonify({'error': 'No image file or image_id found in the request'}), 400
+    filters = request.form.getlist('filter') or FILTERS
+    try:
+        size = int(request.form.get('thumbnail_size', GALLERY_DEFAULT_SIZE))
+    except ValueError:
+        return jsonify({'error': 'thumbnail_size must be an integer'}), 400
+    if not 0 < size <= GALLERY_MAX_SIZE:
+        return jsonify({'error': f'thumbnail_size must be between 1 and {GALLERY_MAX_SIZE}'}), 400
 
-def apply_filter(img, filter_type):
     try:
-        # Apply the chosen filter
-        if filter_type == "digicam":
-
-            img = add_date_stamp_bottom_right(
-            img,
-            padding=100,        # Increase padding if you want more spacing from edges
-            font_size=122,
-            color=(255,222,33)
-            )
-
-            img = add_green_tint(img, 1.023)
-
-            brightness_enhancer = ImageEnhance.Brightness(img)
-            img = brightness_enhancer.enhance(1.2)  # 1.2 => 20% brighter
-
-            color_enhancer = ImageEnhance.Color(img)
-            img = color_enhancer.enhance(1.95)  # 1.3 => 30% more saturation
-
-            contrast_enhancer = ImageEnhance.Contrast(img)
-            img = contrast_enhancer.enhance(1.15)  # 1.2 => subtle pop in contrast
-
-
-            # 2) Mild film grain
-            img = add_film_grain(img, intensity=45, offset=20)
-            # Explanation:
-            #  - "intensity=20" means noise up to 20
-            #  - "offset=10" shifts the brightness less drastically
-
-            # 3) Subtle vignette
-            img = apply_vignette(img, radius_factor=1.7, strength=0.3)
-            # Explanation:
-            #  - "radius_factor=1.8" => fairly large vignette ellipse
-            #  - "strength=0.3" => corners only a little darker
-
-            # 4) Optional: gentle halation (glow on highlights)
-            img = add_halation(img, blur_radius=5, intensity=0.1)
-            # Explanation:
-            #  - Smaller blur_radius=10 => less “spread” of bloom
-            #  - intensity=0.2 => only a mild glow
-
-            # 5) Optional: mild light leaks
-            # Keep alpha small so it doesn't overwhelm the image
-            img = add_light_leaks(img, leak_count=2, alpha=0.05)
-
-            # 6) If you want a slight warm color shift
-            # (You could skip this if your image is already warm)
-            enhancer = ImageEnhance.Color(img)
-            img = enhancer.enhance(1.05)  # a slight push over normal
-        elif filter_type == "sepia":
-            img = apply_sepia(img)
-        elif filter_type == "invert":
-            img = ImageOps.invert(img)
-        elif filter_type == "brightness":
-            enhancer = ImageEnhance.Brightness(img)
-            img = enhancer.enhance(1.5)
-        elif filter_type == "contrast":
-            enhancer = ImageEnhance.Contrast(img)
-            img = enhancer.enhance(2.0)
-        elif filter_type == "saturate":
-            enhancer = ImageEnhance.Color(img)
-            img = enhancer.enhance(2.0)
-        else:
-            raise ValueError("Unsupported filter type.")
-        return img
+        thumb = request_image(size).convert('RGB')
+    except LookupError as e:
+        return jsonify({'error': str(e)}), 404
     except Exception as e:
-        raise e
+        return jsonify({'error': str(e)}), 500
 
-@app.route('/apply-filter', methods=['POST'])
-def upload_and_filter():
-    if 'image' not in request.files:
+    shared = {}
+    thumbnails = {}
+    errors = {}
+    for filter_type in filters:
+        try:
+            # Some filters draw on their input, so each one gets a copy
+            filtered_img = apply_filter(thumb.copy(), filter_type, shared)
+            img_io = io.BytesIO()
+            filtered_img.save(img_io, format="JPEG")
+            thumbnails[filter_type] = base64.b64encode(img_io.getvalue()).decode('utf-8')
+        except Exception as e:
+            errors[filter_type] = str(e)
+    return jsonify({'width': thumb.width, 'height': thumb.height,
+                    'thumbnails': thumbnails, 'errors': errors})
+
+############################
+# Batch processing
+############################
+BATCH_MAX_IMAGES = int(os.environ.get("BATCH_MAX_IMAGES", 32))
+BATCH_WORKERS = int(os.environ.get("BATCH_WORKERS", min(4, os.cpu_count() or 1)))
+batch_executor = ThreadPoolExecutor(max_workers=BATCH_WORKERS)
+
+def _filter_batch_item(data, filter_type, max_dimension, request_timer=None):
+    # Runs in a batch_executor thread, which does not see the request's
+    # timer; the item's stages are added to it, summed over the items
+    timer = StageTimer()
+    try:
+        with timer.activate():
+            with stage("decode"):
+                img = open_image(io.BytesIO(data), max_dimension)
+            img_io, original_format = filter_image(img, filter_type)
+        return img_io.getvalue(), original_format
+    finally:
+        if request_timer is not None:
+            request_timer.add(timer)
+
+@app.route('/apply-filter/batch', methods=['POST'])
+def upload_and_filter_batch():
+    """
+    Applies filters to several images in one request.
+
+    Send the images as repeated 'image' files and either one 'filter' for all
+    of them or one 'filter' per image, in the same order. The response is a
+    zip with the results in request order (000.jpeg, 001.jpeg, ...) and a
+    manifest.json describing every item, including per-item errors.
+    """
+    files = request.files.getlist('image')
+    filters = request.form.getlist('filter')
+    if not files:
         return jsonify({'error': 'No image file found in the request'}), 400
-    if 'filter' not in request.form:
+    if not filters:
         return jsonify({'error': 'No filter specified in the request'}), 400
-
-    file = request.files['image']
-    filter_type = request.form['filter']
+    if len(files) > BATCH_MAX_IMAGES:
+        return jsonify({'error': f'At most {BATCH_MAX_IMAGES} images per batch'}), 400
+    if len(filters) == 1:
+        filters = filters * len(files)
+    if len(filters) != len(files):
+        return jsonify({'error': 'Send one filter, or one filter per image'}), 400
     try:
-        # Always reload the original image for each request
-        img = ImageOps.exif_transpose(Image.open(file.stream))
-
-        # Apply the selected filter
-        filtered_img = apply_filter(img, filter_type)
-
-        # Save the processed image to a BytesIO object
-        img_io = io.BytesIO()
-        original_format = filtered_img.format or "JPEG"
-        filtered_img.save(img_io, format=original_format)
-        img_io.seek(0)
-
-        # Return the processed image
-        return send_file(img_io, mimetype=f'image/{original_format.lower()}')
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        max_dimension = parse_max_dimension(request.form.get('max_dimension'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    # Read the uploads here; the request streams are not safe to share with workers
+    futures = [batch_executor.submit(_filter_batch_item, file.read(), filter_type, max_dimension, g.get('timer'))
+               for file, filter_type in zip(files, filters)]
+
+    zip_io = io.BytesIO()
+    manifest = []
+    with zipfile.ZipFile(zip_io, 'w', zipfile.ZIP_STORED) as archive:
+        for index, (future, filter_type) in enumerate(zip(futures, filters)):
+            item = {'index': index, 'filter': filter_type}
+            try:
+                data, original_format = future.result()
+                name = f'{index:03d}.{original_format.lower()}'
+                archive.writestr(name, data)
+                item['file'] = name
+            except Exception as e:
+                item['error'] = str(e)
+            manifest.append(item)
+        archive.writestr('manifest.json', json.dumps(manifest, indent=2))
+    zip_io.seek(0)
+    return send_file(zip_io, mimetype='application/zip', download_name='filtered.zip')
 
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0')
@@ -0,0 +1,146 @@
+"""
+Tests for the effect registry and pipeline compiler in filters.py.
+
+    cd flask-server && python -m pytest -q
+"""
+import numpy as np
+import pytest
+from PIL import Image
+
+import filters as F
+
+def photo(width=160, height=120, seed=0):
+    """
+    Synthetic photo: smooth color gradients plus noise, so every channel
+    and most of the 0-255 range is used.
+    """
+    rng = np.random.RandomState(seed)
+    y, x = np.mgrid[0:height, 0:width]
+    rgb = np.stack([127 + 120 * np.sin(x / 17.0), 127 + 120 * np.cos(y / 11.0),
+                    255 * (x + y) / (width + height)], -1)
+    rgb += rng.normal(0, 20, (height, width, 3))
+    return Image.fromarray(np.clip(rgb, 0, 255).astype(np.uint8))
+
+def pixels(img):
+    return np.asarray(img.convert("RGB"), dtype=np.int16)
+
+def run(spec, img, seed=1):
+    return F.compile_pipeline(spec).run(img.copy(), seed=seed, stamp_text="2024-01-01 12:00")
+
+############################
+# Specs
+############################
+@pytest.mark.parametrize("name", F.FILTERS)
+def test_presets_compile(name):
+    plan = F.compile_pipeline(name)
+    assert plan.steps
+    assert plan.random == (name in F.RANDOM_FILTERS)
+    assert plan.stamped == (name in F.STAMPED_FILTERS)
+
+def test_spec_defaults_and_cache():
+    spec = {"ops": [{"op": "vignette", "params": {"strength": 0.5}}, {"op": "grain"}]}
+    reordered = {"ops": [{"params": {"strength": 0.5}, "op": "vignette"}, {"op": "grain", "params": {}}]}
+    plan = F.compile_pipeline(spec)
+    assert plan.random and not plan.stamped
+    assert F.compile_pipeline(dict(spec)) is plan
+    assert F.compile_pipeline(reordered).steps[0][0] == "vignette"
+    assert not F.is_repeatable(spec) and F.is_repeatable(spec, seed=1)
+
+@pytest.mark.parametrize("spec, message", [
+    ("no-such-preset", "Unsupported filter type"),
+    ([{"op": "sepia"}], "one key"),
+    ({"ops": []}, "1 to"),
+    ({"ops": [{"op": "sepia"}] * (F.PIPELINE_MAX_OPS + 1)}, "1 to"),
+    ({"ops": [{"op": "sepia"}], "extra": 1}, "one key"),
+    ({"ops": ["sepia"]}, "ops[0]"),
+    ({"ops": [{"op": "sepia", "extra": 1}]}, "ops[0]"),
+    ({"ops": [{"op": "dust"}]}, "unknown op"),
+    ({"ops": [{"op": "vignette", "params": {"size": 1}}]}, "size"),
+    ({"ops": [{"op": "vignette", "params": {"strength": 2}}]}, "strength"),
+    ({"ops": [{"op": "vignette", "params": {"strength": "0.5"}}]}, "strength"),
+    ({"ops": [{"op": "posterize", "params": {"bits": 2.5}}]}, "bits"),
+    ({"ops": [{"op": "posterize", "params": {"bits": True}}]}, "bits"),
+    ({"ops": [{"op": "stamp", "params": {"color": [255, 0]}}]}, "color"),
+    ({"ops": [{"op": "stamp", "params": {"font": "comic-sans"}}]}, "font"),
+    ({"ops": [{"op": "lens_flare", "params": {"radius": 5000}}]}, "radius"),
+    ({"ops": [{"op": "sepia"}, {"op": "vignette", "params": {"strength": -1}}]}, "ops[1]"),
+    ({"ops": [{"op": "brightness", "params": {"factor": float("nan")}}]}, "JSON"),
+])
+def test_invalid_specs(spec, message):
+    with pytest.raises(ValueError, match=message.replace("[", r"\[").replace("]", r"\]")):
+        F.compile_pipeline(spec)
+
+@pytest.mark.parametrize("op", sorted(F.EFFECTS))
+@pytest.mark.parametrize("mode", ["P", "L", "I;16", "RGBA"])
+def test_ops_accept_any_mode(op, mode):
+    img = photo(96, 64)
+    img = img.convert("L").convert(mode) if mode == "I;16" else img.convert(mode)
+    out = run({"ops": [{"op": op}]}, img)
+    # polaroid adds a frame around the picture
+    assert out.width >= img.width and out.height >= img.height
+    assert pixels(out).shape[2] == 3
+
+############################
+# Fusion
+############################
+def test_adjacent_luts_fuse_in_order():
+    img = photo()
+    spec = {"ops": [{"op": "posterize", "params": {"bits": 2}}, {"op": "invert"},
+                    {"op": "cross_process"}]}
+    plan = F.compile_pipeline(spec)
+    assert [name for name, _ in plan.steps] == ["posterize+invert+cross_process"]
+    staged = F.apply_cross_processing(Image.eval(F.apply_posterize(img, 2), lambda v: 255 - v))
+    assert np.array_equal(pixels(run(spec, img)), pixels(staged))
+
+    swapped = {"ops": [spec["ops"][1], spec["ops"][0], spec["ops"][2]]}
+    assert not np.array_equal(pixels(run(spec, img)), pixels(run(swapped, img)))
+
+def test_color_ops_fuse_in_order():
+    img = photo()
+    ops = [{"op": "green_tint", "params": {"factor": 1.1}}, {"op": "brightness", "params": {"factor": 1.2}},
+           {"op": "saturation", "params": {"factor": 1.6}}, {"op": "contrast", "params": {"factor": 1.3}}]
+    plan = F.compile_pipeline({"ops": ops})
+    # The per-channel prefix becomes a table, the rest one matrix step
+    assert len(plan.steps) == 2
+    assert [name for name, _ in plan.steps] == ["green_tint+brightness", "saturation+contrast"]
+
+    staged = img
+    for op in ops:
+        staged = run({"ops": [op]}, staged)
+    diff = np.abs(pixels(run({"ops": ops}, img)) - pixels(staged))
+    assert diff.mean() < 1 and np.percentile(diff, 99) <= 3
+
+    reversed_ops = run({"ops": ops[::-1]}, img)
+    assert np.abs(pixels(reversed_ops) - pixels(staged)).mean() > 2
+
+def test_fused_steps_named_after_their_ops():
+    # Only the ops ahead of the first mixing one go in the table
+    plan = F.compile_pipeline({"ops": [{"op": "brightness"}, {"op": "sepia"}, {"op": "green_tint"},
+                                       {"op": "contrast"}]})
+    assert [name for name, _ in plan.steps] == ["brightness", "sepia+green_tint+contrast"]
+
+def test_fusion_stops_at_other_effects():
+    plan = F.compile_pipeline({"ops": [{"op": "invert"}, {"op": "vignette"}, {"op": "posterize"},
+                                       {"op": "brightness"}, {"op": "saturation"}]})
+    # brightness joins posterize's table, saturation stays a matrix step
+    assert [name for name, _ in plan.steps] == ["invert", "vignette", "posterize+brightness", "saturation"]
+
+############################
+# Determinism
+############################
+@pytest.mark.parametrize("name", sorted(F.RANDOM_FILTERS))
+def test_seeded_presets_repeat(name):
+    img = photo()
+    first = pixels(F.apply_filter(img.copy(), name, seed=7, stamp_text="2024-01-01 12:00"))
+    again = pixels(F.apply_filter(img.copy(), name, seed=7, stamp_text="2024-01-01 12:00"))
+    other = pixels(F.apply_filter(img.copy(), name, seed=8, stamp_text="2024-01-01 12:00"))
+    assert np.array_equal(first, again)
+    assert not np.array_equal(first, other)
+    assert F.is_repeatable(name, 7) and not F.is_repeatable(name)
+
+def test_seeded_random_ops_repeat():
+    spec = {"ops": [{"op": "grain"}, {"op": "light_leaks"}, {"op": "vhs", "params": {"displacement": 3}},
+                    {"op": "lens_flare"}]}
+    img = photo()
+    assert np.array_equal(pixels(run(spec, img, seed=3)), pixels(run(spec, img, seed=3)))
+    assert not np.array_equal(pixels(run(spec, img, seed=3)), pixels(run(spec, img, seed=4)))
@@ -0,0 +1,53 @@
+"""
+Tests that filters processed in strips under a small memory budget give
+the same result as processing the whole frame at once.
+
+    cd flask-server && python -m pytest -q
+"""
+import numpy as np
+import pytest
+
+import filters as F
+from test_pipelines import photo
+
+WIDTH, HEIGHT = 320, 240
+
+def assert_tiled_equal(func, bytes_per_pixel, halo=0, align=1, rows=64):
+    """
+    Runs func(img, budget=...) with a budget of rows rows (halo included,
+    down to STRIP_MIN_ROWS per strip), checks the frame really was split,
+    and compares with budget=None.
+    """
+    img = photo(WIDTH, HEIGHT, seed=2)
+    budget = WIDTH * bytes_per_pixel * rows
+    assert F.strip_rows(WIDTH, HEIGHT, bytes_per_pixel, halo, budget, align) < HEIGHT
+    whole = np.asarray(func(img.copy(), budget=None))
+    tiled = np.asarray(func(img.copy(), budget=budget))
+    assert np.array_equal(whole, tiled)
+
+@pytest.mark.parametrize("radius_factor, strength", [(1.6, 0.7), (1.3, 1.0)])
+def test_vignette(radius_factor, strength):
+    assert_tiled_equal(lambda img, budget: F.apply_vignette(img, radius_factor, strength, budget=budget), 12)
+
+@pytest.mark.parametrize("blur_radius", [5, 15, 40])
+def test_halation(blur_radius):
+    assert_tiled_equal(lambda img, budget: F.add_halation(img, blur_radius, budget=budget), 16,
+                       F.blur_halo(blur_radius), F.blur_factor(blur_radius))
+
+@pytest.mark.parametrize("blur_strength", [6, 15, 30])
+def test_tilt_shift(blur_strength):
+    assert_tiled_equal(lambda img, budget: F.apply_tilt_shift(img, blur_strength, budget=budget), 16,
+                       F.blur_halo(blur_strength), F.blur_factor(blur_strength))
+
+@pytest.mark.parametrize("seed", [1, 2])
+def test_digicam(seed):
+    assert_tiled_equal(lambda img, budget: F.render_digicam(img, rng=F.make_rng(seed), leak_count=6,
+                                                            leak_alpha=0.3, budget=budget),
+                       F.DIGICAM_BYTES_PER_PIXEL, F.blur_halo(5))
+
+@pytest.mark.parametrize("width, height", [(641, 481), (97, 1003)])
+def test_vignette_rows_match_frame(width, height):
+    whole = np.asarray(F.vignette_rows(width, height, 1.6, 0.7, 0, height))
+    strips = [np.asarray(F.vignette_rows(width, height, 1.6, 0.7, top, min(top + 17, height)))
+              for top in range(0, height, 17)]
+    assert np.array_equal(whole, np.concatenate(strips))
@@ -0,0 +1,129 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+############################
+# Stage Timing
+############################
+# A StageTimer collects how long each stage of one request took. The server
+# and the Lambda handler activate one per request and report it in a
+# Server-Timing header. Code further down (apply_filter, render_digicam)
+# marks its sub-stages with the module-level stage(), which does nothing
+# when no timer is active. A stage costs two perf_counter calls, so timing
+# stays on in production.
+#
+# Set TIMING_TRACE_LOG to a file path to also append every request's stages
+# to it as one JSON object per line.
+
+_active_timer = ContextVar("stage_timer", default=None)
+
+class StageTimer:
+    """
+    Records (name, start, seconds) for each stage of one request. Stages
+    nest: a stage opened inside "filter" is recorded as "filter.<name>".
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = []
+        self._prefix = ""
+        self._token = None
+
+    @contextmanager
+    def stage(self, name):
+        outer = self._prefix
+        full_name = outer + name
+        self._prefix = full_name + "."
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages.append((full_name, start - self.started, time.perf_counter() - start))
+            self._prefix = outer
+
+    @contextmanager
+    def activate(self):
+        """
+        Makes this the timer module-level stage() calls report to.
+        """
+        token = _active_timer.set(self)
+        try:
+            yield self
+        finally:
+            _active_timer.reset(token)
+
+    def start(self):
+        """
+        Like activate, for code that cannot wrap the request in a with
+        block (framework hooks); undo with stop().
+        """
+        self._token = _active_timer.set(self)
+        return self
+
+    def stop(self):
+        _active_timer.reset(self._token)
+
+    def add(self, other):
+        """
+        Adds the stages of another timer, e.g. one that timed work in a
+        worker thread, where this timer is not active.
+        """
+        offset = other.started - self.started
+        # One extend of a ready list, so worker threads can add concurrently
+        self.stages.extend([(name, start + offset, seconds) for name, start, seconds in other.stages])
+
+    def totals(self):
+        """
+        :return: dict of stage name -> seconds, summed over repeats (strips,
+                 batch items), in the order stages were first entered
+        """
+        totals = {}
+        for name, _, seconds in sorted(self.stages, key=lambda entry: entry[1]):
+            totals[name] = totals.get(name, 0.0) + seconds
+        return totals
+
+    def server_timing(self):
+        """
+        :return: Server-Timing header value, ending with the total so far
+        """
+        metrics = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in self.totals().items()]
+        metrics.append(f"total;dur={(time.perf_counter() - self.started) * 1000:.1f}")
+        return ", ".join(metrics)
+
+    def trace(self):
+        """
+        :return: List of {"name", "start_ms", "ms"} in start order
+        """
+        return [{"name": name, "start_ms": round(start * 1000, 3), "ms": round(seconds * 1000, 3)}
+                for name, start, seconds in sorted(self.stages, key=lambda entry: entry[1])]
+
+@contextmanager
+def stage(name):
+    """
+    Times the enclosed block as a stage of the active timer, if any.
+    """
+    timer = _active_timer.get()
+    if timer is None:
+        yield
+        return
+    with timer.stage(name):
+        yield
+
+TIMING_TRACE_LOG = os.environ.get("TIMING_TRACE_LOG")
+_trace_lock = threading.Lock()
+
+def write_trace(timer, **fields):
+    """
+    Appends the timer's stages, plus any extra fields, to TIMING_TRACE_LOG.
+    """
+    if not TIMING_TRACE_LOG:
+        return
+    record = dict(fields, total_ms=round((time.perf_counter() - timer.started) * 1000, 3),
+                  stages=timer.trace())
+    line = json.dumps(record) + "\n"
+    with _trace_lock:
+        with open(TIMING_TRACE_LOG, "a") as f:
+            f.write(line)